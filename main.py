@@ -18,22 +18,35 @@ Commands can be found in the commands.py file.
 # todo check string conversion to int
 # todo check for canvas name in existing canvases
 # todo blocked users
-# todo canvas of given size
 # todo class for handlers?
 # todo admin set admin?
 """
+import os
+import asyncio
+import argparse
 import logging
-from telegram.ext import Application, CommandHandler, MessageHandler, filters
+from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters
 from telegram import Update
 from src.my_reply import reply
-from src.commands import COMMANDS, ADMIN_COMMNADS
+from src.architect import get_architect
+from src.write_behind import enable_write_behind, get_flusher
+from src.place import set_canvas_format, set_history_retention, CANVAS_FORMATS
+from src.metrics import start_metrics_export, stop_metrics_export
+from src.webhook import WebhookServer, run_webhook
+from src.outbox import configure_outbox, GLOBAL_RATE, CHAT_RATE
+from src.commands import COMMANDS, ADMIN_COMMNADS, CALLBACKS
 from scripts.utils import read_file
+from scripts.moderation import get_moderator
+from scripts.interaction_log import start_interaction_log, stop_interaction_log, INTERACTION_LOG_PATH
 
 
 # Read the token from the file
 TOKEN_PATH = 'TOKEN.txt'
 TOKEN = read_file(TOKEN_PATH).strip()
 
+# secret token that Telegram sends with each update in webhook mode (optional)
+WEBHOOK_SECRET_PATH = 'WEBHOOK_SECRET.txt'
+
 
 # Enable logging and set higher logging level for httpx
 logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
@@ -41,10 +54,113 @@ logging.getLogger("httpx").setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
 
+def parse_args():
+    """Read the startup options from the command line"""
+    parser = argparse.ArgumentParser(description="Omar2.0 Telegram bot")
+    parser.add_argument("--write-behind", action="store_true",
+                        help="keep the changes in memory and write them to disk in batches")
+    parser.add_argument("--flush-interval", type=float, default=5.,
+                        help="seconds between two write-behind flushes")
+    parser.add_argument("--flush-batch", type=int, default=50,
+                        help="pending changes of a store that trigger an early flush")
+    parser.add_argument("--storage", choices=("csv", "sqlite"), default="csv",
+                        help="user storage backend (the CSV users are migrated to SQLite on first use)")
+    parser.add_argument("--canvas-format", choices=CANVAS_FORMATS, default="csv",
+                        help="canvas file format: csv, npy (memory-mapped), log (snapshots + append-only log "
+                             "of the placements) or chunks (sparse 64x64 chunks, for huge canvases); "
+                             "the CSV canvases are converted on first use")
+    parser.add_argument("--keep-segments", type=int, default=None,
+                        help="log canvases: older segments (snapshot + placements) kept after each "
+                             "snapshot, the rest is removed (default: all the history)")
+    parser.add_argument("--interaction-log", default=INTERACTION_LOG_PATH,
+                        help="JSON lines file of the interactions (rotated)")
+    parser.add_argument("--log-sample-rate", type=float, default=1.,
+                        help="fraction of the interactions that are logged")
+    parser.add_argument("--no-console-log", action="store_true",
+                        help="do not echo the interactions on the console")
+    parser.add_argument("--metrics-file", default=None,
+                        help="Prometheus text file where the performance metrics are exported")
+    parser.add_argument("--metrics-interval", type=float, default=15.,
+                        help="seconds between two exports of the metrics")
+    parser.add_argument("--concurrent-updates", type=int, default=0,
+                        help="number of updates handled in parallel (0: one at a time)")
+    parser.add_argument("--send-rate", type=float, default=GLOBAL_RATE,
+                        help="messages per second sent by the bot in total")
+    parser.add_argument("--chat-send-rate", type=float, default=CHAT_RATE,
+                        help="messages per second sent by the bot to the same chat")
+    parser.add_argument("--mode", choices=("polling", "webhook"), default="polling",
+                        help="get the updates by long polling or with a local webhook server")
+    parser.add_argument("--listen", default="127.0.0.1",
+                        help="address of the webhook server")
+    parser.add_argument("--port", type=int, default=8443,
+                        help="port of the webhook server")
+    parser.add_argument("--url-path", default="",
+                        help="path of the webhook")
+    parser.add_argument("--webhook-url", default=None,
+                        help="public URL registered on Telegram (none: the webhook is not registered, "
+                             "e.g. to POST recorded updates offline)")
+    parser.add_argument("--webhook-secret-file", default=WEBHOOK_SECRET_PATH,
+                        help="file with the secret token of the webhook (ignored if missing)")
+    parser.add_argument("--max-connections", type=int, default=40,
+                        help="connections to the webhook served at once")
+    parser.add_argument("--drop-pending-updates", action="store_true",
+                        help="drop the updates received while the bot was offline")
+    return parser.parse_args()
+
+
+async def post_init(application: Application):
+    """Start the background tasks"""
+    flusher = get_flusher()
+    if flusher is not None:
+        await flusher.start()
+    args = application.bot_data["args"]
+    if args.metrics_file is not None:
+        await start_metrics_export(args.metrics_file, args.metrics_interval)
+
+
+async def post_shutdown(application: Application):
+    """Stop the background tasks and write to disk what is still pending"""
+    args = application.bot_data["args"]
+    if args.metrics_file is not None:
+        await stop_metrics_export(args.metrics_file)
+    flusher = get_flusher()
+    if flusher is not None:
+        await flusher.stop()
+    get_moderator().stop_watching()
+    stop_interaction_log()
+
+
 def main():
     """Start the bot"""
+    args = parse_args()
+    if args.write_behind:
+        enable_write_behind(interval=args.flush_interval, batch_size=args.flush_batch)
+    set_canvas_format(args.canvas_format)
+    set_history_retention(args.keep_segments)
+    configure_outbox(rate=args.send_rate, chat_rate=args.chat_send_rate)
+
+    # compile the bad words now, then follow the edits of the file
+    get_moderator().start_watching()
+
     # Create the Application and pass it your bot's token.
-    application = Application.builder().token(TOKEN).build()
+    builder = (Application.builder().token(TOKEN)
+               .post_init(post_init)
+               .post_shutdown(post_shutdown))
+    if args.mode == "webhook":
+        # the updates come from the webhook server instead of the Updater
+        builder = builder.updater(None)
+    if args.concurrent_updates > 0:
+        # the handlers lock the users they change, see src/locks.py
+        builder = builder.concurrent_updates(args.concurrent_updates)
+    application = builder.build()
+
+    application.bot_data["args"] = args
+
+    # load the users once, the same Architect is then shared by all the handlers
+    application.bot_data["architect"] = get_architect(storage=args.storage)
+
+    start_interaction_log(args.interaction_log, sample_rate=args.log_sample_rate,
+                          console=not args.no_console_log)
 
     # on different commands.py - answer in Telegram
     for command in COMMANDS:
@@ -52,11 +168,25 @@ def main():
     for command in ADMIN_COMMNADS:
         application.add_handler(CommandHandler(command, ADMIN_COMMNADS[command]))
 
+    # inline keyboard buttons (e.g. the pan buttons of /place view)
+    for pattern in CALLBACKS:
+        application.add_handler(CallbackQueryHandler(CALLBACKS[pattern], pattern=pattern))
+
     # on non command i.e. text message - reply to the message on Telegram
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, reply))
 
     # Run the bot until the user presses Ctrl-C
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    if args.mode == "webhook":
+        secret_token = None
+        if os.path.exists(args.webhook_secret_file):
+            secret_token = read_file(args.webhook_secret_file).strip()
+        server = WebhookServer(listen=args.listen, port=args.port, url_path=args.url_path,
+                               secret_token=secret_token, max_connections=args.max_connections)
+        asyncio.run(run_webhook(application, server, webhook_url=args.webhook_url,
+                                drop_pending_updates=args.drop_pending_updates))
+    else:
+        application.run_polling(allowed_updates=Update.ALL_TYPES,
+                                drop_pending_updates=args.drop_pending_updates)
 
 
 if __name__ == "__main__":
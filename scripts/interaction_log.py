@@ -0,0 +1,102 @@
+"""
+Structured interaction log: one JSON line per reply of the bot.
+The handlers only put the record in a queue, a QueueListener thread
+does the formatting and the (rotating) file and console I/O.
+"""
+import json
+import logging
+import logging.handlers
+import queue
+import random
+from contextvars import ContextVar
+from time import time, perf_counter, gmtime, strftime
+
+
+INTERACTION_LOG_PATH = 'DATA/PRIVATE/interactions.jsonl'
+
+logger = logging.getLogger("interactions")
+logger.propagate = False
+
+# perf_counter() when the handling of the current update started
+_START = ContextVar("interaction_start", default=None)
+
+_LISTENER = None
+_SAMPLE_RATE = 1.
+
+
+class JsonFormatter(logging.Formatter):
+    """Format the interaction as a JSON line"""
+
+    def format(self, record):
+        return json.dumps(record.interaction, ensure_ascii=False)
+
+
+class ConsoleFormatter(logging.Formatter):
+    """Format the interaction for humans, like the old console output"""
+
+    def format(self, record):
+        info = record.interaction
+        t_string = strftime("%H:%M:%S", gmtime(info["timestamp"]))
+        return f"\n[{t_string}] {info['user_name']}: {record.user_message}\n>>> {record.reply_text}"
+
+
+def start_interaction_log(path=INTERACTION_LOG_PATH, sample_rate=1., console=True,
+                          max_bytes=10_000_000, backup_count=5):
+    """Start the background thread that writes the interactions.
+    Only a `sample_rate` fraction of the interactions is logged."""
+    global _LISTENER, _SAMPLE_RATE
+    if _LISTENER is not None:
+        return
+    _SAMPLE_RATE = sample_rate
+
+    file_handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes,
+                                                        backupCount=backup_count, encoding='utf-8')
+    file_handler.setFormatter(JsonFormatter())
+    handlers = [file_handler]
+    if console:
+        console_handler = logging.StreamHandler()
+        console_handler.setFormatter(ConsoleFormatter())
+        handlers.append(console_handler)
+
+    log_queue = queue.SimpleQueue()
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    logger.setLevel(logging.INFO)
+    _LISTENER = logging.handlers.QueueListener(log_queue, *handlers)
+    _LISTENER.start()
+
+
+def stop_interaction_log():
+    """Write the queued interactions and stop the background thread"""
+    global _LISTENER
+    if _LISTENER is not None:
+        _LISTENER.stop()
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+        _LISTENER = None
+
+
+def is_logging() -> bool:
+    return _LISTENER is not None
+
+
+def start_interaction():
+    """Mark the start of the handling of an update, to measure the latency"""
+    _START.set(perf_counter())
+
+
+def log_interaction(user_id, user_name: str, user_message: str, reply_text: str):
+    """Queue the record of an interaction (never blocks on I/O)"""
+    if _SAMPLE_RATE < 1 and random.random() >= _SAMPLE_RATE:
+        return
+    start = _START.get()
+    words = user_message.split(maxsplit=1)
+    command = words[0] if words and words[0].startswith('/') else "message"
+    interaction = {"timestamp": time(),
+                   "user_id": user_id,
+                   "user_name": user_name,
+                   "command": command,
+                   "latency": None if start is None else perf_counter() - start,
+                   "reply_size": len(reply_text)}
+    logger.info(command, extra={"interaction": interaction,
+                                "user_message": user_message,
+                                "reply_text": reply_text})
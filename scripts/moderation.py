@@ -0,0 +1,173 @@
+"""
+Moderation engine: the bad word list is read once and compiled into a single regex,
+with the common prefixes of the words merged.
+The list can be edited while the bot runs: a watcher thread compiles
+the new version and swaps it in, the messages being moderated keep the old one.
+"""
+import os
+import re
+import threading
+
+
+BAD_WORDS_PATH = 'data/bad_words.txt'
+
+# one HotModerator per word list, shared by the whole process
+_MODERATORS = dict()
+
+# "İ" is the only character whose lowercase is two characters long:
+# map it to "i", as the IGNORECASE regexes do
+_SAME_LENGTH_LOWER = {ord("İ"): "i"}
+
+
+def trie_pattern(words) -> str:
+    """Regex that matches any of the words, with the common prefixes merged (a trie):
+    at each position of the text the regex engine follows one branch per character
+    instead of trying every word. A word wins over its own prefixes."""
+    trie = dict()
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, dict())
+        node[''] = None  # a word ends here
+    return _node_pattern(trie)
+
+
+def _node_pattern(node) -> str:
+    branches = [re.escape(char) + _node_pattern(child) for char, child in sorted(node.items()) if char]
+    if '' in node:
+        # the longer words first (greedy), then the word that ends here
+        return '(?:' + '|'.join(branches) + ')?' if branches else ''
+    return branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+
+
+class Moderator:
+    """Replace the bad words (case-insensitive) with asterisks.
+    Immutable: a new word list means a new Moderator."""
+
+    def __init__(self, words, min_length=5, version=0):
+        self.version = version
+        # short words would censor too many innocent words
+        words = {w.lower() for w in words if len(w) >= min_length}
+        self.max_length = max(map(len, words), default=0)
+        # the text is lowercased before matching: without IGNORECASE the regex is much faster
+        self.pattern = re.compile(trie_pattern(words)) if words else None
+
+    @classmethod
+    def from_file(cls, word_path=BAD_WORDS_PATH, min_length=5, version=0):
+        with open(word_path, 'r') as f:
+            return cls(f.read().splitlines(), min_length=min_length, version=version)
+
+    def _find(self, text):
+        """Yield the (start, end) of the bad words in the text"""
+        lowered = text.lower()
+        if len(lowered) != len(text):
+            # the positions must be the ones of the text
+            lowered = text.translate(_SAME_LENGTH_LOWER).lower()
+        for match in self.pattern.finditer(lowered):
+            yield match.span()
+
+    @staticmethod
+    def _censor(text, spans) -> str:
+        """The text with asterisks over the spans"""
+        pieces = []
+        pos = 0
+        for start, end in spans:
+            pieces.append(text[pos:start])
+            pieces.append('*' * (end - start))
+            pos = end
+        pieces.append(text[pos:])
+        return ''.join(pieces)
+
+    def moderate(self, text: str) -> str:
+        """Return the text without bad words"""
+        if self.pattern is None:
+            return text
+        spans = list(self._find(text))
+        return self._censor(text, spans) if spans else text
+
+    def moderate_stream(self, chunks):
+        """Moderate a long text given in chunks, yield the moderated pieces.
+        The tail that could still be the start of a bad word is held back:
+        a word that starts before the cut is entirely in the buffer,
+        so each piece is scanned only once (with the held back tail)."""
+        keep = max(self.max_length - 1, 0)
+        buffer = ''
+        for chunk in chunks:
+            buffer += chunk
+            cut = len(buffer) - keep
+            if cut <= 0:
+                continue
+            spans = []
+            if self.pattern is not None:
+                for start, end in self._find(buffer):
+                    if start >= cut:
+                        # might continue in the next chunk
+                        break
+                    spans.append((start, end))
+                    cut = max(cut, end)
+            yield self._censor(buffer[:cut], spans)
+            buffer = buffer[cut:]
+        if buffer:
+            yield self.moderate(buffer)
+
+
+class HotModerator:
+    """Moderate with the latest compiled snapshot of a word list.
+    Once watching, a background thread checks the file every `interval` seconds,
+    compiles the new list off the asyncio loop and swaps the snapshot in one assignment."""
+
+    def __init__(self, word_path=BAD_WORDS_PATH, interval=2.):
+        self.word_path = word_path
+        self.interval = interval
+        self.mtime = os.stat(word_path).st_mtime_ns
+        self.snapshot = Moderator.from_file(word_path)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def moderate(self, text: str) -> str:
+        """Return the text without bad words"""
+        return self.snapshot.moderate(text)
+
+    def moderate_stream(self, chunks):
+        """Moderate a text given in chunks, all of it with the same snapshot"""
+        return self.snapshot.moderate_stream(chunks)
+
+    def reload(self) -> bool:
+        """Compile the word list again if the file changed, return True if swapped"""
+        mtime = os.stat(self.word_path).st_mtime_ns
+        if mtime == self.mtime:
+            return False
+        snapshot = Moderator.from_file(self.word_path, version=self.snapshot.version + 1)
+        self.mtime = mtime
+        self.snapshot = snapshot
+        print(f">>> Reloaded {self.word_path} (version {snapshot.version})")
+        return True
+
+    def _watch(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.reload()
+            except OSError as e:
+                # keep the old snapshot, e.g. while the file is being replaced
+                print(f">>> Could not reload {self.word_path}: {e}")
+
+    def start_watching(self):
+        """Start the watcher thread"""
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._watch, name="moderation-watcher", daemon=True)
+            self._thread.start()
+
+    def stop_watching(self):
+        """Stop the watcher thread"""
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+
+def get_moderator(word_path=BAD_WORDS_PATH) -> HotModerator:
+    """Return the shared moderator for word_path, compiled on first use"""
+    if word_path not in _MODERATORS:
+        _MODERATORS[word_path] = HotModerator(word_path)
+    return _MODERATORS[word_path]
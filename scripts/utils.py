@@ -2,6 +2,8 @@ from telegram import Update
 import numpy as np
 from time import time, gmtime, strftime
 import os
+from scripts.moderation import get_moderator, BAD_WORDS_PATH
+from scripts.interaction_log import is_logging, log_interaction
 
 
 DEFAULT_EMOJI = ["⬜️", "🟥", "🟧", "🟨", "🟩", "🟪",
@@ -42,9 +44,13 @@ def get_user_id(update):
 
 
 def show_interaction(update: Update, reply_text: str):
-    """Print message on the console."""
+    """Log the interaction (JSON lines, written in the background),
+    or print it on the console if the interaction log is not running."""
     username = get_user_full_name(update.effective_user)
     user_message = get_message_text(update)
+    if is_logging():
+        log_interaction(update.effective_user.id, username, user_message, reply_text)
+        return
     t_string = strftime("%H:%M:%S", gmtime(time()))
     print(f"\n[{t_string}] {username}: {user_message}")
     print(f">>> {reply_text}")
@@ -126,12 +132,6 @@ def write_user_csv_file(file_name, user_info):
         f.write(s)
 
 
-def moderate(text, word_path='data/bad_words.txt'):
+def moderate(text, word_path=BAD_WORDS_PATH):
     """Return the text without bad words."""
-    with open(word_path, 'r') as f:
-        bad_words = f.read().splitlines()
-    for bad_word in bad_words:
-        if len(bad_word) < 5:
-            continue
-        text = text.replace(bad_word, '*' * len(bad_word))
-    return text
+    return get_moderator(word_path).moderate(text)
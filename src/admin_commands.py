@@ -2,11 +2,18 @@
 Define a few command handlers.
 These usually take the two arguments update and context.
 """
+from functools import wraps
 from telegram import Update
 from telegram.ext import ContextTypes
-from src.architect import Architect
+from src.architect import get_architect
 from scripts.pasgen_2024 import generate_password
 from scripts.utils import show_interaction
+from scripts.interaction_log import start_interaction
+from src.metrics import METRICS, timed
+from src.async_storage import get_async_store, run_io
+from src.place import create_place_async, get_canvas_names, get_place_async
+from src.locks import LOCKS, user_key
+from src.outbox import reply_text
 from scripts.utils import get_user_full_name, get_user_id
 
 
@@ -14,26 +21,30 @@ ADMIN_COMMNADS = dict()
 
 
 def check_admin_wrapper(func):
+    @wraps(func)
     async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_id = get_user_id(update)
-        architect = Architect()
+        architect = get_architect()
         if architect.is_admin(user_id):
             await func(update, context)
         else:
             text = "Non sei un admin!"
             show_interaction(update, text)
-            await update.message.reply_text(text)
+            await reply_text(update, text)
 
     return wrapper
 
 
 def command_wrapper(func):
 
+    @wraps(func)
     async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         # if message is an edit then skip reply
         if hasattr(update.message, 'reply_text'):
-            await func(update, context)
+            start_interaction()
+            with timed("command", func.__name__):
+                await func(update, context)
 
     return wrapper
 
@@ -43,7 +54,7 @@ def command_wrapper(func):
 async def admin_get_user_ids_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Get list of ids and usernames """
     args = context.args
-    architect = Architect()
+    architect = get_architect()
 
     if len(args) == 0:
         user_ids = architect.get_user_ids()
@@ -55,14 +66,14 @@ async def admin_get_user_ids_command(update: Update, context: ContextTypes.DEFAU
     for user_id in sorted(user_ids):
         text += f"\n{user_id} {architect.get_user_name(user_id)}"
     show_interaction(update, text)
-    await update.message.reply_text(text)
+    await reply_text(update, text)
 
 
 @command_wrapper
 @check_admin_wrapper
 async def admin_set_emoji_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Set user's emoji"""
-    architect = Architect()
+    architect = get_architect()
     args = context.args
     if len(args) == 2:
         user_id = int(args[0])
@@ -75,28 +86,46 @@ async def admin_set_emoji_command(update: Update, context: ContextTypes.DEFAULT_
     else:
         text = "Usage: /set_emoji [user_id] [emoji]"
     show_interaction(update, text)
-    await update.message.reply_text(text)
+    await reply_text(update, text)
 
 
 @command_wrapper
 @check_admin_wrapper
 async def admin_canvas_names_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Get list of canvas names"""
-    architect = Architect()
     _ = context.args
-    canvas_names = architect.get_canvas_names()
+    canvas_names = get_canvas_names()
     text = f"🎨 {len(canvas_names)} canvases:"
     for canvas_name in canvas_names:
         text += f"\n- {canvas_name}"
     show_interaction(update, text)
-    await update.message.reply_text(text)
+    await reply_text(update, text)
+
+
+@command_wrapper
+@check_admin_wrapper
+async def admin_new_canvas_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Create a (chunked) canvas of the given size"""
+    args = context.args
+    if len(args) == 3 and args[1].isdigit() and args[2].isdigit():
+        canvas = f'{args[0].lower()}.csv'
+        rows, cols = int(args[1]), int(args[2])
+        try:
+            await create_place_async(canvas, (rows, cols))
+            text = f'🎨 Canvas "{canvas}" {rows}x{cols} created'
+        except ValueError as e:
+            text = f'{e}!'
+    else:
+        text = "Usage: /new_canvas [canvas] [rows] [cols]"
+    show_interaction(update, text)
+    await reply_text(update, text)
 
 
 @command_wrapper
 @check_admin_wrapper
 async def admin_set_canvas_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Set user's canvas"""
-    architect = Architect()
+    architect = get_architect()
     args = context.args
     if len(args) == 2:
         user_id = int(args[0])
@@ -105,7 +134,7 @@ async def admin_set_canvas_command(update: Update, context: ContextTypes.DEFAULT
         else:
             canvas = f'{args[1].lower()}.csv'
 
-            if canvas in architect.get_canvas_names():
+            if canvas in get_canvas_names():
                 architect.set_canvas(user_id, canvas)
                 text = f'🎨 Canvas "{canvas}" set for user {user_id}'
             else:
@@ -113,14 +142,38 @@ async def admin_set_canvas_command(update: Update, context: ContextTypes.DEFAULT
     else:
         text = "Usage: /set_canvas [user_id] [canvas]"
     show_interaction(update, text)
-    await update.message.reply_text(text)
+    await reply_text(update, text)
+
+
+@command_wrapper
+@check_admin_wrapper
+async def admin_compact_canvas_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Write a snapshot of a canvas in log format, removing the history beyond the retention"""
+    args = context.args
+    if len(args) == 1:
+        canvas = f'{args[0].lower()}.csv'
+        if canvas not in get_canvas_names():
+            text = f'Canvas "{canvas}" not found!'
+        else:
+            place = await get_place_async(canvas)
+            if place.is_event_log():
+                place.compact()
+                await get_async_store(place).save()
+                segments = await run_io(place.event_log.get_segments)
+                text = f'🗜 Canvas "{canvas}" compacted: {len(segments)} segments on disk'
+            else:
+                text = f'Canvas "{canvas}" has no event log'
+    else:
+        text = "Usage: /compact_canvas [canvas]"
+    show_interaction(update, text)
+    await reply_text(update, text)
 
 
 @command_wrapper
 @check_admin_wrapper
 async def admin_get_info_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Get user's info"""
-    architect = Architect()
+    architect = get_architect()
     args = context.args
     if len(args) == 1:
         user_id = int(args[0])
@@ -135,14 +188,14 @@ async def admin_get_info_command(update: Update, context: ContextTypes.DEFAULT_T
     else:
         text = "Usage: /get_info [user_id]"
     show_interaction(update, text)
-    await update.message.reply_text(text)
+    await reply_text(update, text)
 
 
 @command_wrapper
 @check_admin_wrapper
 async def admin_set_santa_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Set user's santa"""
-    architect = Architect()
+    architect = get_architect()
     args = context.args
     if len(args) == 2:
         user_id = int(args[0])
@@ -155,14 +208,14 @@ async def admin_set_santa_command(update: Update, context: ContextTypes.DEFAULT_
     else:
         text = "Usage: /set_santa [user_id] [True/False]"
     show_interaction(update, text)
-    await update.message.reply_text(text)
+    await reply_text(update, text)
 
 
 @command_wrapper
 @check_admin_wrapper
 async def admin_check_santa_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Check which users already used the santa command this year."""
-    architect = Architect()
+    architect = get_architect()
     _ = context.args
 
     santas = architect.get_santas()
@@ -178,7 +231,7 @@ async def admin_check_santa_command(update: Update, context: ContextTypes.DEFAUL
             text = f"{n} santas didn't use the command yet!"
 
     show_interaction(update, text)
-    await update.message.reply_text(text)
+    await reply_text(update, text)
 
 
 @command_wrapper
@@ -204,14 +257,14 @@ async def admin_password_command(update: Update, context: ContextTypes.DEFAULT_T
                 text = f"Usage: /password [key] [length]"
 
     show_interaction(update, text)
-    await update.message.reply_text(text)
+    await reply_text(update, text)
 
 
 @command_wrapper
 @check_admin_wrapper
 async def admin_give_gems_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Give gems to a user"""
-    architect = Architect()
+    architect = get_architect()
     args = context.args
     if len(args) == 2:
         user_id = int(args[0])
@@ -221,35 +274,40 @@ async def admin_give_gems_command(update: Update, context: ContextTypes.DEFAULT_
             gems = int(args[1])
 
             text = ''
-            if gems > 0:
-                architect.increase_gems(user_id, gems)
-                user_name = architect.get_user_name(user_id)
-                s = "" if gems == 1 else "s"
-                text += f'🔹 {gems} gem{s} given to user {user_name}\n'
-            elif gems < 0:
-                architect.decrease_gems(user_id, -gems)
-                user_name = architect.get_user_name(user_id)
-                s = "" if gems == -1 else "s"
-                text += f'🔹 {-gems} gem{s} removed from user {user_name}\n'
-
-            text += f'New total: {architect.get_item(user_id, "gems", 0)} gems 🔹 '
+            async with LOCKS.hold(user_key(user_id)):
+                with architect.transaction(user_id):
+                    if gems > 0:
+                        architect.increase_gems(user_id, gems)
+                        user_name = architect.get_user_name(user_id)
+                        s = "" if gems == 1 else "s"
+                        text += f'🔹 {gems} gem{s} given to user {user_name}\n'
+                    elif gems < 0:
+                        architect.decrease_gems(user_id, -gems)
+                        user_name = architect.get_user_name(user_id)
+                        s = "" if gems == -1 else "s"
+                        text += f'🔹 {-gems} gem{s} removed from user {user_name}\n'
+
+                    text += f'New total: {architect.get_item(user_id, "gems", 0)} gems 🔹 '
+                await get_async_store(architect).save()
     else:
         text = 'Give gems to a user\n'
         text += "Usage: /give_gems [user_id] [gems]"
     show_interaction(update, text)
-    await update.message.reply_text(text)
+    await reply_text(update, text)
 
 
 @command_wrapper
 @check_admin_wrapper
 async def admin_list_gems_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """List all users with their gems, sorted by amount"""
-    architect = Architect()
+    architect = get_architect()
     _ = context.args
 
-    user_ids = architect.get_user_ids()
-    gems = {user_id: architect.get_item(user_id, 'gems', 0) for user_id in user_ids}
-    sorted_gems = sorted(gems.items(), key=lambda x: x[1], reverse=True)
+    # the leaderboard is already sorted, the users without gems go between positive and negative
+    ranking = architect.get_leaderboard("gems")
+    scores = architect.leaderboards["gems"].scores
+    no_gems = [(user_id, 0) for user_id in architect.get_user_ids() if user_id not in scores]
+    sorted_gems = [x for x in ranking if x[1] > 0] + no_gems + [x for x in ranking if x[1] < 0]
 
     text = "🔹 Gems 🔹 \n"
     for user_id, gem in sorted_gems:
@@ -257,14 +315,14 @@ async def admin_list_gems_command(update: Update, context: ContextTypes.DEFAULT_
         text += f"{gem:_>5}  {user_name}\n"
 
     show_interaction(update, text)
-    await update.message.reply_text(text)
+    await reply_text(update, text)
 
 
 @command_wrapper
 @check_admin_wrapper
 async def admin_get_user_info_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show all the user info"""
-    architect = Architect()
+    architect = get_architect()
     args = context.args
     if len(args) == 1:
         user_id = int(args[0])
@@ -278,7 +336,18 @@ async def admin_get_user_info_command(update: Update, context: ContextTypes.DEFA
     else:
         text = "Usage: /get_user_info [user_id]"
     show_interaction(update, text)
-    await update.message.reply_text(text)
+    await reply_text(update, text)
+
+
+@command_wrapper
+@check_admin_wrapper
+async def admin_stats_perf_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show count, errors and latency percentiles of the commands and of the storage"""
+    _ = context.args
+    text = "⏱ Performance ⏱\n"
+    text += METRICS.summary()
+    show_interaction(update, text)
+    await reply_text(update, text)
 
 
 def main():
@@ -301,9 +370,12 @@ def main():
     # canvas
     ADMIN_COMMNADS["canvas_names"] = admin_canvas_names_command
     ADMIN_COMMNADS["set_canvas"] = admin_set_canvas_command
+    ADMIN_COMMNADS["new_canvas"] = admin_new_canvas_command
+    ADMIN_COMMNADS["compact_canvas"] = admin_compact_canvas_command
 
     # misc
     ADMIN_COMMNADS["password"] = admin_password_command
+    ADMIN_COMMNADS["stats_perf"] = admin_stats_perf_command
 
 
 if __name__ == "src.admin_commands":
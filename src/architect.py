@@ -2,32 +2,53 @@
 This is the Architect class. It is used to manage the users.
 """
 import os
+import copy
 import hashlib
+from contextlib import contextmanager
 from time import gmtime, strftime
 import numpy as np
-from scripts.utils import DEFAULT_EMOJI, read_user_csv_file, write_user_csv_file
+from scripts.utils import DEFAULT_EMOJI
+from src.leaderboard import Leaderboard
+from src.metrics import timed
+from src.storage import CsvUserStorage, SqliteUserStorage, migrate_csv_to_sqlite
+from src.write_behind import get_flusher
+from src.async_storage import get_async_store
 import cv2
 from typing import List
 
 
+# one long-lived Architect per data directory, shared by all the handlers
+_ARCHITECTS = dict()
+
+
 class Architect:
     """Class to manage the users"""
 
-    def __init__(self, data_dir="DATA"):
+    def __init__(self, data_dir="DATA", storage="csv"):
         # directories
         self.data_dir = data_dir
         self.private_data_dir = os.path.join(data_dir, "PRIVATE")
         self.canvases_dir = os.path.join(data_dir, "canvases")
         self.users_dir = os.path.join(self.private_data_dir, "users")
         self.photos_dir = os.path.join(self.private_data_dir, "photos")
+        self.users_db_path = os.path.join(self.private_data_dir, "users.sqlite3")
         self.directories = (self.data_dir, self.canvases_dir, self.users_dir, self.photos_dir)
 
         # attributes
         self.user_info = dict()
         self.default_emoji = DEFAULT_EMOJI
+        self.dirty_users = set()  # users changed since the last save
+        self.deleted_users = set()  # users whose file must be removed
+        self._batch_depth = 0
+        self.emoji_version = 0  # increased every time the emoji of a user may have changed
+        self._emoji_table = None
+        self.leaderboards = {"gems": Leaderboard(), "tiles_count": Leaderboard()}
+        self.flusher = None  # writes the changes: WriteBehindFlusher or AsyncStore
+        self._writes_in_flight = 0
 
         # build environment
         self._build_env()
+        self.storage = self._open_storage(storage)
         self._load_user_info()
 
     def get_user_message_path(self):
@@ -45,11 +66,21 @@ class Architect:
     def set_item(self, user_id, key, value):
         """Set a key-value pair for a user"""
         self.user_info[user_id][key] = value
+        self.dirty_users.add(user_id)
+        if key == "emoji":
+            self.emoji_version += 1
+        if key in self.leaderboards:
+            self.leaderboards[key].update(user_id, value)
         self.save_user_info()
 
     def del_item(self, user_id, key):
         """Delete a key-value pair for a user"""
         del self.user_info[user_id][key]
+        self.dirty_users.add(user_id)
+        if key == "emoji":
+            self.emoji_version += 1
+        if key in self.leaderboards:
+            self.leaderboards[key].remove(user_id)
         self.save_user_info()
 
     def get_random_emoji(self):
@@ -57,19 +88,111 @@ class Architect:
         i = np.random.randint(len(self.default_emoji))
         return self.default_emoji[i]
 
+    def _open_storage(self, storage):
+        """Return the user storage backend: "csv", "sqlite" or a backend instance"""
+        if storage == "csv":
+            return CsvUserStorage(self.users_dir)
+        elif storage == "sqlite":
+            if not os.path.exists(self.users_db_path):
+                n = migrate_csv_to_sqlite(self.users_dir, self.users_db_path)
+                print(f">>> Migrated {n} users to {self.users_db_path}")
+            return SqliteUserStorage(self.users_db_path)
+        else:
+            return storage
+
+    def load(self):
+        """Read all the users from the storage again"""
+        self._load_user_info()
+        self.emoji_version += 1
+
     def _load_user_info(self):
-        """Load the users from the user.pkl file"""
-        for file_name in os.listdir(self.users_dir):
-            if file_name.endswith('.csv'):
-                user_id = int(file_name.split('.')[0])
-                path = os.path.join(self.users_dir, file_name)
-                self.user_info[user_id] = read_user_csv_file(path)
+        """Load the users from the storage"""
+        with timed("storage", "architect_load"):
+            self.user_info = self.storage.load_users()
+        self.leaderboards = {key: Leaderboard() for key in self.leaderboards}
+        for user_id in self.user_info:
+            self._update_leaderboards(user_id)
+
+    def _update_leaderboards(self, user_id):
+        """Copy the scores of a user into the leaderboards"""
+        for key, leaderboard in self.leaderboards.items():
+            if user_id in self.user_info:
+                leaderboard.update(user_id, self.get_item(user_id, key, 0))
+            else:
+                leaderboard.remove(user_id)
 
     def save_user_info(self):
-        """Save the users to the user.pkl file"""
-        for user_id in self.user_info:
-            path = f'{self.users_dir}/{user_id}.csv'
-            write_user_csv_file(path, self.user_info[user_id])
+        """Save the users that changed since the last save (postponed inside a batch)"""
+        if self._batch_depth:
+            return
+        if self.flusher is not None:
+            self.flusher.notify(self)
+        else:
+            self.flush()
+
+    def n_pending(self) -> int:
+        """Number of users not yet saved"""
+        return len(self.dirty_users) + len(self.deleted_users)
+
+    def take_pending(self):
+        """Detach a copy of the changes, so that another thread can write them"""
+        users = {user_id: copy.deepcopy(self.user_info[user_id]) for user_id in self.dirty_users}
+        deleted = tuple(self.deleted_users)
+        self.dirty_users.clear()
+        self.deleted_users.clear()
+        self._writes_in_flight += 1
+        return users, deleted
+
+    def write_pending(self, pending):
+        """Write the changes detached by take_pending"""
+        users, deleted = pending
+        try:
+            with timed("storage", "architect_save"):
+                self.storage.save_users(users)
+                self.storage.delete_users(deleted)
+        finally:
+            self._writes_in_flight -= 1
+
+    def restore_pending(self, pending):
+        """The write of the changes detached by take_pending failed: save them again
+        (the users as they are now, which includes the failed changes)"""
+        users, deleted = pending
+        self.dirty_users.update(user_id for user_id in users if user_id in self.user_info)
+        self.deleted_users.update(user_id for user_id in deleted if user_id not in self.user_info)
+
+    def flush(self):
+        """Write the changed users to disk"""
+        self.write_pending(self.take_pending())
+
+    @contextmanager
+    def batch(self):
+        """Fold all the saves inside the block into a single one at the end"""
+        self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            self._batch_depth -= 1
+            self.save_user_info()
+
+    @contextmanager
+    def transaction(self, user_id):
+        """Apply all the changes to a user in the block as one atomic operation:
+        a single save at the end, everything rolled back if the block raises.
+        The block must not await: all the handlers run in the same thread,
+        so no other handler can interleave with it. A handler that awaits
+        between reading and changing a user holds LOCKS.hold(user_key(user_id))."""
+        backup = copy.deepcopy(self.user_info[user_id])
+        self._batch_depth += 1
+        try:
+            yield self
+        except BaseException:
+            self.user_info[user_id] = backup
+            self.emoji_version += 1
+            self._update_leaderboards(user_id)
+            raise
+        finally:
+            self._batch_depth -= 1
+            self.save_user_info()
 
     def _build_env(self, verbose=True):
         # create directories
@@ -97,10 +220,11 @@ class Architect:
         if user_id not in self.user_info:
             # default user info
             self.user_info[user_id] = dict()
-            self.set_item(user_id, "username", user_name)
-            self.set_item(user_id, "emoji", self.get_random_emoji())
-            self.set_item(user_id, "achievements", dict())
-            self.save_user_info()
+            self.deleted_users.discard(user_id)
+            with self.batch():
+                self.set_item(user_id, "username", user_name)
+                self.set_item(user_id, "emoji", self.get_random_emoji())
+                self.set_item(user_id, "achievements", dict())
         else:
             print(f"User {user_name} ({user_id}) already exists")
 
@@ -115,8 +239,19 @@ class Architect:
     def del_user(self, user_id):
         """Delete a user from the user.pkl file"""
         del self.user_info[user_id]
+        self.dirty_users.discard(user_id)
+        self.deleted_users.add(user_id)
+        self.emoji_version += 1
+        self._update_leaderboards(user_id)
         self.save_user_info()
 
+    def get_emoji_table(self) -> dict:
+        """Return the {user_id: emoji} table, rebuilt only when an emoji changed"""
+        if self._emoji_table is None or self._emoji_table[0] != self.emoji_version:
+            table = {user_id: self.get_user_emoji(user_id) for user_id in self.user_info}
+            self._emoji_table = (self.emoji_version, table)
+        return self._emoji_table[1]
+
     def get_user_names(self) -> list:
         """Return the usernames from the user.pkl file"""
         return [user["username"] for user in self.user_info.values()]
@@ -124,7 +259,6 @@ class Architect:
     def set_emoji(self, user_id, emoji):
         """Set the emoji for a user"""
         self.set_item(user_id, "emoji", emoji)
-        self.save_user_info()
 
     def get_last_place_time(self, user_id):
         """Get the last time the place was used"""
@@ -133,7 +267,6 @@ class Architect:
     def set_last_place_time(self, user_id, time):
         """Set the last time the place was used"""
         self.set_item(user_id, "last_place_time", time)
-        self.save_user_info()
 
     def get_place_tiles_count(self, user_id) -> int:
         """Get the number of tiles placed by a user"""
@@ -143,22 +276,25 @@ class Architect:
         """Add the number of tiles placed by a user"""
         n = self.get_place_tiles_count(user_id) + count
         self.set_item(user_id, "tiles_count", n)
-        self.save_user_info()
 
     def set_admin(self, user_id, admin=True):
         """Set the admin flag for a user"""
         self.set_item(user_id, "admin", admin)
-        self.save_user_info()
 
     def set_santa(self, user_id, santa=True):
         """Set the santa flag for a user"""
         self.set_item(user_id, "santa", santa)
-        self.save_user_info()
+
+    def _get_flagged_ids(self, flag) -> tuple:
+        """Return the ids of the users with the flag set, sorted (the santas are
+        assigned in this order), with an indexed query if possible"""
+        if hasattr(self.storage, 'get_flagged_ids') and not self.n_pending() and not self._writes_in_flight:
+            return tuple(sorted(self.storage.get_flagged_ids(flag)))
+        return tuple(sorted(user_id for user_id in self.user_info if self.get_item(user_id, flag, False)))
 
     def get_santas(self) -> tuple:
         """Return the user ids of the Santas"""
-        v = [user_id for user_id in self.user_info if self.get_item(user_id, "santa", False)]
-        return tuple(v)
+        return self._get_flagged_ids("santa")
 
     def get_gems(self, user_id):
         """Get the number of gems for a user"""
@@ -169,44 +305,37 @@ class Architect:
         assert n_gems >= 0, "Gems must be greater than zero"
         n = self.get_gems(user_id) + n_gems
         self.set_item(user_id, "gems", n)
-        self.save_user_info()
 
     def decrease_gems(self, user_id, n_gems):
         """Decrease the number of gems for a user"""
         assert n_gems >= 0, "Gems must be greater than zero"
         n = self.get_gems(user_id) - n_gems
         self.set_item(user_id, "gems", n)
-        self.save_user_info()
 
-    def get_tile_leaderboard(self):
+    def get_leaderboard(self, key, k=None) -> list:
+        """Return the (user_id, score) of the k users with the highest non-zero
+        "gems" or "tiles_count" (all of them if k is None)"""
+        return self.leaderboards[key].top(k)
+
+    def _leaderboard_columns(self, key, k=None):
+        """Return the names, emojis and scores of the top k users"""
+        v = self.get_leaderboard(key, k)
+        names = tuple(self.get_user_name(user_id) for user_id, _ in v)
+        emojis = tuple(self.get_user_emoji(user_id) for user_id, _ in v)
+        scores = tuple(score for _, score in v)
+        return names, emojis, scores
+
+    def get_tile_leaderboard(self, k=None):
         """Return the leaderboard for the number of tiles placed by each user"""
-        v = []
-        for user_id in self.user_info:
-            n_tiles = self.get_place_tiles_count(user_id)
-            if n_tiles:
-                emoji = self.get_user_emoji(user_id)
-                name = self.get_user_name(user_id)
-                v.append((name, emoji, n_tiles))
-        v.sort(key=lambda x: x[2], reverse=True)
-        names, emojis, tiles = zip(*v)
-        return names, emojis, tiles
-
-    def get_gems_leaderboard(self):
+        return self._leaderboard_columns("tiles_count", k)
+
+    def get_gems_leaderboard(self, k=None):
         """Return the leaderboard for the number of gems for all users"""
-        v = []
-        for user_id in self.user_info:
-            n_gems = self.get_gems(user_id)
-            if n_gems:
-                emoji = self.get_user_emoji(user_id)
-                name = self.get_user_name(user_id)
-                v.append((name, emoji, n_gems))
-        v.sort(key=lambda x: x[2], reverse=True)
-        names, emojis, n_gems = zip(*v)
-        return names, emojis, n_gems
+        return self._leaderboard_columns("gems", k)
 
     def get_admins(self) -> tuple:
         """get a tuple of all the admin ids"""
-        return tuple([user_id for user_id in self.user_info if self.get_item(user_id, "admin", False)])
+        return self._get_flagged_ids("admin")
 
     def get_user_messages(self) -> list:
         """Get the last user message"""
@@ -234,7 +363,6 @@ class Architect:
     def set_canvas(self, user_id, canvas: str):
         """Set the canvas for a user"""
         self.set_item(user_id, "canvas", canvas)
-        self.save_user_info()
 
     def is_admin(self, user_id):
         """Return True if user is admin, else False """
@@ -242,7 +370,7 @@ class Architect:
 
     def get_admin_ids(self):
         """Return a list of admin ids"""
-        return tuple([user_id for user_id in self.user_info if self.get_item(user_id, 'admin', False)])
+        return self._get_flagged_ids("admin")
 
     def set_user_emoji(self, user_id, emoji):
         """Set the emoji for a user"""
@@ -309,3 +437,14 @@ class Architect:
         if santa not in active_santas:
             with open(filename, 'a') as f:
                 f.write(f'{santa}\n')
+
+
+def get_architect(data_dir="DATA", storage="csv") -> Architect:
+    """Return the shared Architect for data_dir, loading the users on first use"""
+    if data_dir not in _ARCHITECTS:
+        _ARCHITECTS[data_dir] = Architect(data_dir=data_dir, storage=storage)
+        flusher = get_flusher()
+        if flusher is not None:
+            flusher.register(_ARCHITECTS[data_dir])
+        get_async_store(_ARCHITECTS[data_dir])
+    return _ARCHITECTS[data_dir]
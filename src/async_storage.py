@@ -0,0 +1,93 @@
+"""
+Async storage facade: the stores (Architect, Place) apply the changes in memory,
+the disk I/O runs in a dedicated thread so the handlers never block the event loop.
+
+A store detaches a copy of its changes with take_pending() in the event loop,
+and write_pending() writes that copy in the I/O thread.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+
+# a single I/O thread: the writes are done in the order they were scheduled
+IO_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="storage-io")
+
+# AsyncStore of each store, by id of the store
+_ASYNC_STORES = dict()
+
+# seconds before a failed write is tried again
+RETRY_DELAY = 1.
+
+
+async def run_io(func, *args):
+    """Run a blocking storage function in the I/O thread"""
+    return await asyncio.get_running_loop().run_in_executor(IO_EXECUTOR, func, *args)
+
+
+class AsyncStore:
+    """Awaitable save over a store.
+    Unless the store is in write-behind mode, the changes are written
+    in the I/O thread as soon as the store saves them. While a write is
+    running, the following changes are collected and written together after it.
+    A failed write puts its changes back in the store and is tried again later."""
+
+    def __init__(self, store):
+        self.store = store
+        self._writing = None  # future of the running write
+        self._retry = None  # TimerHandle of the next try after a failed write
+        if store.flusher is None:
+            store.flusher = self
+
+    def notify(self, store):
+        """Called by the store when it saves: schedule the write in the I/O thread"""
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # not running in the bot (scripts, tests), write right away
+            store.flush()
+            return
+        if self._writing is None or self._writing.done():
+            self._submit(loop)
+
+    def _submit(self, loop):
+        pending = self.store.take_pending()
+        self._writing = loop.run_in_executor(IO_EXECUTOR, self.store.write_pending, pending)
+        self._writing.add_done_callback(lambda future: self._on_written(future, pending))
+
+    def _on_written(self, future, pending):
+        """Runs in the event loop after a write: on errors put the changes back
+        and try again later, otherwise write what changed meanwhile"""
+        loop = future.get_loop()
+        if future.exception() is not None:
+            print(f">>> Could not save {type(self.store).__name__}: {future.exception()}")
+            self.store.restore_pending(pending)
+            if self._retry is None:
+                self._retry = loop.call_later(RETRY_DELAY, self._try_again, loop)
+        elif self.store.flusher is self and self.store.n_pending() and future is self._writing:
+            self._submit(loop)
+
+    def _try_again(self, loop):
+        self._retry = None
+        if (self._writing is None or self._writing.done()) and self.store.n_pending():
+            self._submit(loop)
+
+    async def save(self):
+        """Wait until the changes made so far are on disk
+        (in write-behind mode the flusher takes care of them instead).
+        After a failed write it does not wait for the next try."""
+        if self.store.flusher is not self:
+            return
+        while True:
+            if self._writing is not None and not self._writing.done():
+                await asyncio.wait([self._writing])
+            elif self.store.n_pending() and self._retry is None:
+                self._submit(asyncio.get_running_loop())
+            else:
+                break
+
+
+def get_async_store(store) -> AsyncStore:
+    """Return the AsyncStore of a store, created on first use"""
+    if id(store) not in _ASYNC_STORES:
+        _ASYNC_STORES[id(store)] = AsyncStore(store)
+    return _ASYNC_STORES[id(store)]
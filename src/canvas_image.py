@@ -0,0 +1,150 @@
+"""
+PNG rendering of a canvas, for canvases too big for the emoji text.
+Each user gets a color (the one of their emoji when it is a colored
+square or circle, otherwise one derived from the user id).
+The image is split in tiles: after a placement only the tile that
+contains the tile of the canvas is drawn again.
+"""
+import numpy as np
+import cv2
+
+
+# canvas cells per side of an image tile
+TILE_SIZE = 32
+
+# largest side of the image (pixels) and largest cell (pixels per canvas cell)
+MAX_IMAGE_SIDE = 2048
+MAX_CELL_SIZE = 24
+
+# cells at least this big get a grid line
+MIN_GRID_CELL_SIZE = 6
+
+# BGR colors
+EMPTY_COLOR = (235, 235, 235)
+GRID_COLOR = (210, 210, 210)
+EMOJI_COLORS = {"⬜️": (250, 250, 250), "⬜": (250, 250, 250), "⬛": (30, 30, 30), "⬛️": (30, 30, 30),
+                "🟥": (49, 49, 221), "🟧": (0, 140, 244), "🟨": (54, 211, 253), "🟩": (80, 176, 120),
+                "🟦": (226, 147, 72), "🟪": (177, 94, 170), "🟫": (45, 85, 140),
+                "⚪": (245, 245, 245), "⚫": (40, 40, 40), "🔴": (49, 49, 221), "🟠": (0, 140, 244),
+                "🟡": (54, 211, 253), "🟢": (80, 176, 120), "🔵": (226, 147, 72), "🟣": (177, 94, 170),
+                "🟤": (45, 85, 140)}
+
+
+def get_cell_size(shape) -> int:
+    """Pixels per canvas cell, so that the image is at most MAX_IMAGE_SIDE wide"""
+    return int(np.clip(MAX_IMAGE_SIDE // max(shape), 1, MAX_CELL_SIZE))
+
+
+def hash_colors(user_ids) -> np.ndarray:
+    """A bright, well spread BGR color for each user id (splitmix64 of the id)"""
+    z = np.asarray(user_ids, dtype=np.int64).astype(np.uint64) + np.uint64(0x9E3779B97F4A7C15)
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    z = z ^ (z >> np.uint64(31))
+    channels = np.stack([(z >> np.uint64(shift)) & np.uint64(0xFF) for shift in (0, 8, 16)], axis=-1)
+    # keep away from the background and from black
+    return (40 + channels.astype(np.uint16) * 180 // 255).astype(np.uint8)
+
+
+def get_user_colors(user_ids, emoji_table) -> list:
+    """BGR color of each user id (EMPTY_COLOR for 0)"""
+    hashed = hash_colors(user_ids).tolist()
+    return [EMPTY_COLOR if user_id == 0 else EMOJI_COLORS.get(emoji_table.get(user_id), tuple(color))
+            for user_id, color in zip(user_ids, hashed)]
+
+
+def render_pixels(colors, cell_size) -> np.ndarray:
+    """Image of a block of the canvas, from the BGR color of each cell"""
+    # x left to right, y bottom to top
+    colors = colors.transpose(1, 0, 2)[::-1]
+    s = cell_size
+    pixels = np.repeat(np.repeat(colors, s, axis=0), s, axis=1)
+    if s >= MIN_GRID_CELL_SIZE:
+        pixels[::s] = GRID_COLOR
+        pixels[:, ::s] = GRID_COLOR
+    return pixels
+
+
+def paint_cells(pixels, n_cols, x, y, colors, cell_size):
+    """Paint the canvas cells (x[i], y[i]) with colors[i], all at once"""
+    s = cell_size
+    offsets = np.arange(s)
+    rows = ((n_cols - 1 - y) * s)[:, None, None] + offsets[None, :, None]
+    cols = (x * s)[:, None, None] + offsets[None, None, :]
+    blocks = np.broadcast_to(np.asarray(colors, dtype=np.uint8)[:, None, None, :], (len(x), s, s, 3)).copy()
+    if s >= MIN_GRID_CELL_SIZE:
+        blocks[:, 0] = GRID_COLOR
+        blocks[:, :, 0] = GRID_COLOR
+    pixels[rows, cols] = blocks
+
+
+class CanvasImage:
+    """The pixels of a canvas, rendered again one tile at a time, and the PNG encoded from them.
+    Canvas cell (x, y) is drawn at column x and row (n_cols - 1 - y), like the text rendering."""
+
+    def __init__(self, shape, cell_size=None):
+        self.shape = tuple(shape)
+        self.cell_size = get_cell_size(self.shape) if cell_size is None else cell_size
+        self.pixels = None  # BGR image, None until the first render
+        self.dirty_tiles = set()  # (x, y) index of the tiles to draw again
+        self.emoji_version = None  # Architect.emoji_version the colors come from
+        self._colors = dict()  # user_id -> BGR color
+        self._palette_colors = None  # BGR color of each index of the palette
+        self._png = None
+
+    def mark_dirty(self, x, y):
+        """The canvas cell (x, y) changed"""
+        self.dirty_tiles.add((x // TILE_SIZE, y // TILE_SIZE))
+        self._png = None
+
+    def mark_all_dirty(self):
+        self.pixels = None
+        self.dirty_tiles.clear()
+        self._png = None
+
+    def _get_colors(self, user_ids, emoji_table) -> np.ndarray:
+        """BGR color of each of the (distinct) user ids"""
+        missing = [user_id for user_id in user_ids if user_id not in self._colors]
+        if missing:
+            self._colors.update(zip(missing, get_user_colors(missing, emoji_table)))
+        return np.array([self._colors[user_id] for user_id in user_ids], dtype=np.uint8)
+
+    def _get_palette_colors(self, palette, emoji_table) -> np.ndarray:
+        """BGR color of each index of the palette (the palette only grows)"""
+        if self._palette_colors is None or len(self._palette_colors) != len(palette):
+            self._palette_colors = self._get_colors(palette.tolist(), emoji_table)
+        return self._palette_colors
+
+    def _render_tile(self, grid, colors, tx, ty):
+        rows, cols = self.shape
+        x0, y0 = tx * TILE_SIZE, ty * TILE_SIZE
+        x1, y1 = min(x0 + TILE_SIZE, rows), min(y0 + TILE_SIZE, cols)
+        s = self.cell_size
+        self.pixels[(cols - y1) * s:(cols - y0) * s, x0 * s:x1 * s] = \
+            render_pixels(colors[grid[x0:x1, y0:y1]], s)
+
+    def render(self, grid, palette, emoji_table, emoji_version) -> np.ndarray:
+        """Bring the pixels up to date with the canvas (grid of palette indices), return them"""
+        if emoji_version != self.emoji_version:
+            # the emojis, and so the colors, may have changed
+            self.emoji_version = emoji_version
+            self._colors.clear()
+            self._palette_colors = None
+            self.mark_all_dirty()
+        colors = self._get_palette_colors(palette, emoji_table)
+        if self.pixels is None:
+            self.pixels = render_pixels(colors[grid], self.cell_size)
+        else:
+            for tx, ty in self.dirty_tiles:
+                self._render_tile(grid, colors, tx, ty)
+        self.dirty_tiles.clear()
+        return self.pixels
+
+    def to_png(self, grid, palette, emoji_table, emoji_version) -> bytes:
+        """PNG of the canvas, encoded again only if something changed"""
+        pixels = self.render(grid, palette, emoji_table, emoji_version)
+        if self._png is None:
+            ok, buffer = cv2.imencode(".png", pixels)
+            assert ok, "Could not encode the canvas as PNG"
+            self._png = buffer.tobytes()
+        return self._png
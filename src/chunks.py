@@ -0,0 +1,217 @@
+"""
+Chunked grid for arbitrarily large and sparse canvases.
+
+<canvas>.chunks/
+    meta.json             shape, chunk size and dtype of the grid
+    palette.npy           the palette of the canvas (see Place)
+    chunk-<cx>-<cy>.npy   the CHUNK_SIZE x CHUNK_SIZE block of cells at (cx, cy)
+A chunk is created (in memory and on disk) only when one of its cells is set,
+read from disk only when one of its cells is read, and written only if it changed.
+Missing chunks are empty (all zeros).
+"""
+import os
+import json
+import numpy as np
+
+
+CHUNK_SIZE = 64
+
+
+class ChunkedGrid:
+    """The part of the ndarray interface used by Place: grid[x, y], grid[x0:x1, y0:y1],
+    shape and dtype. np.asarray(grid) builds the dense grid (only for small canvases)."""
+
+    def __init__(self, path, shape, dtype=np.uint16, chunk_size=CHUNK_SIZE):
+        self.path = path
+        self.shape = tuple(int(n) for n in shape)
+        self.dtype = np.dtype(dtype)
+        self.chunk_size = chunk_size
+        self.dirty_chunks = set()  # keys of the chunks changed since the last write
+        self._chunks = dict()  # (cx, cy) -> chunk, the ones in memory
+        self._files = set()  # keys of the chunks on disk
+
+    @classmethod
+    def open(cls, path):
+        """The grid stored in the directory (FileNotFoundError if there is none)"""
+        with open(os.path.join(path, "meta.json"), encoding="utf-8") as f:
+            meta = json.load(f)
+        grid = cls(path, meta["shape"], meta["dtype"], meta["chunk_size"])
+        for name in os.listdir(path):
+            if name.startswith("chunk-") and name.endswith(".npy"):
+                cx, cy = name[len("chunk-"):-len(".npy")].split("-")
+                grid._files.add((int(cx), int(cy)))
+        return grid
+
+    @classmethod
+    def from_array(cls, path, array):
+        """Split a dense grid in chunks (all of them to be written)"""
+        array = np.asarray(array)
+        grid = cls(path, array.shape, array.dtype)
+        s = grid.chunk_size
+        for cx in range(-(-array.shape[0] // s)):
+            for cy in range(-(-array.shape[1] // s)):
+                block = array[cx * s:(cx + 1) * s, cy * s:(cy + 1) * s]
+                if block.any():
+                    chunk = grid._get_chunk((cx, cy), create=True)
+                    chunk[:block.shape[0], :block.shape[1]] = block
+                    grid.dirty_chunks.add((cx, cy))
+        return grid
+
+    def get_meta(self) -> dict:
+        return {"shape": list(self.shape), "dtype": self.dtype.name, "chunk_size": self.chunk_size}
+
+    def _chunk_path(self, key):
+        return os.path.join(self.path, f"chunk-{key[0]}-{key[1]}.npy")
+
+    def _get_chunk(self, key, create=False):
+        chunk = self._chunks.get(key)
+        if chunk is None:
+            if key in self._files:
+                chunk = np.load(self._chunk_path(key)).astype(self.dtype, copy=False)
+                self._chunks[key] = chunk
+            elif create:
+                chunk = np.zeros((self.chunk_size, self.chunk_size), dtype=self.dtype)
+                self._chunks[key] = chunk
+        return chunk
+
+    def _load_all(self):
+        for key in self._files:
+            self._get_chunk(key)
+
+    def n_chunks(self) -> int:
+        """Chunks that hold at least one cell"""
+        return len(self._files | set(self._chunks))
+
+    def get_bounds(self):
+        """Corners (x0, y0), (x1, y1) of the smallest block that contains all the chunks in use"""
+        keys = self._files | set(self._chunks)
+        s = self.chunk_size
+        if not keys:
+            return 0, 0, min(s, self.shape[0]), min(s, self.shape[1])
+        cx, cy = zip(*keys)
+        return (min(cx) * s, min(cy) * s,
+                min((max(cx) + 1) * s, self.shape[0]), min((max(cy) + 1) * s, self.shape[1]))
+
+    def __len__(self):
+        return self.shape[0]
+
+    @staticmethod
+    def _to_range(index, n):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(n)
+            assert step == 1, "Chunked grids only support contiguous slices"
+            return start, max(start, stop), False
+        index = int(index)
+        if not -n <= index < n:
+            raise IndexError(f"index {index} out of bounds for size {n}")
+        index %= n
+        return index, index + 1, True
+
+    def __getitem__(self, key):
+        kx, ky = key if isinstance(key, tuple) else (key, slice(None))
+        x0, x1, squeeze_x = self._to_range(kx, self.shape[0])
+        y0, y1, squeeze_y = self._to_range(ky, self.shape[1])
+        if squeeze_x and squeeze_y:
+            s = self.chunk_size
+            chunk = self._get_chunk((x0 // s, y0 // s))
+            return self.dtype.type(0) if chunk is None else chunk[x0 % s, y0 % s]
+        block = self.get_block(x0, y0, x1, y1)
+        if squeeze_x:
+            block = block[0]
+        elif squeeze_y:
+            block = block[:, 0]
+        return block
+
+    def get_block(self, x0, y0, x1, y1) -> np.ndarray:
+        """Dense copy of the cells [x0:x1, y0:y1], reading only the chunks it overlaps"""
+        s = self.chunk_size
+        block = np.zeros((x1 - x0, y1 - y0), dtype=self.dtype)
+        for cx in range(x0 // s, -(-x1 // s)):
+            for cy in range(y0 // s, -(-y1 // s)):
+                chunk = self._get_chunk((cx, cy))
+                if chunk is None:
+                    continue
+                ax0, ax1 = max(x0, cx * s), min(x1, (cx + 1) * s)
+                ay0, ay1 = max(y0, cy * s), min(y1, (cy + 1) * s)
+                block[ax0 - x0:ax1 - x0, ay0 - y0:ay1 - y0] = chunk[ax0 - cx * s:ax1 - cx * s,
+                                                                    ay0 - cy * s:ay1 - cy * s]
+        return block
+
+    def __setitem__(self, key, value):
+        x, y = key
+        x, _, _ = self._to_range(x, self.shape[0])
+        y, _, _ = self._to_range(y, self.shape[1])
+        s = self.chunk_size
+        chunk_key = (x // s, y // s)
+        chunk = self._get_chunk(chunk_key, create=value != 0)
+        if chunk is not None:
+            chunk[x % s, y % s] = value
+            self.dirty_chunks.add(chunk_key)
+
+    def __array__(self, dtype=None, copy=None):
+        block = self.get_block(0, 0, *self.shape)
+        return block if dtype is None else block.astype(dtype)
+
+    def bincount(self, minlength=0) -> np.ndarray:
+        """np.bincount of all the cells, without building the dense grid"""
+        self._load_all()
+        counts = np.zeros(minlength, dtype=np.int64)
+        n_cells = 0
+        for chunk in self._chunks.values():
+            chunk_counts = np.bincount(chunk.ravel(), minlength=minlength)
+            if len(chunk_counts) > len(counts):
+                counts = np.pad(counts, (0, len(chunk_counts) - len(counts)))
+            counts[:len(chunk_counts)] += chunk_counts
+            n_cells += chunk.size
+        if len(counts) == 0:
+            counts = np.zeros(1, dtype=np.int64)
+        # the cells of the missing chunks (and the padding of the chunks at the border)
+        counts[0] += self.shape[0] * self.shape[1] - n_cells
+        return counts
+
+    def unique(self) -> np.ndarray:
+        """The values in the grid"""
+        self._load_all()
+        values = [np.unique(chunk) for chunk in self._chunks.values()]
+        return np.unique(np.concatenate([[0]] + values)).astype(self.dtype)
+
+    def remap(self, lookup, dtype):
+        """Replace every value v with lookup[v], stored as dtype (all chunks are written again)"""
+        self._load_all()
+        self.dtype = np.dtype(dtype)
+        for key, chunk in self._chunks.items():
+            self._chunks[key] = lookup[chunk].astype(self.dtype)
+            self.dirty_chunks.add(key)
+
+    def take_dirty(self) -> dict:
+        """Detach copies of the changed chunks for write_dirty (None: delete the empty chunk)"""
+        chunks = dict()
+        for key in self.dirty_chunks:
+            chunk = self._chunks.get(key)
+            if chunk is not None and chunk.any():
+                chunks[key] = chunk.copy()
+                self._files.add(key)
+            else:
+                # no cell set anymore: the chunk is dropped
+                chunks[key] = None
+                self._chunks.pop(key, None)
+                self._files.discard(key)
+        self.dirty_chunks.clear()
+        return chunks
+
+    def write_dirty(self, chunks, meta):
+        """Write the chunks detached by take_dirty, and the metadata"""
+        os.makedirs(self.path, exist_ok=True)
+        meta_path = os.path.join(self.path, "meta.json")
+        with open(meta_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        os.replace(meta_path + ".tmp", meta_path)
+        for key, chunk in chunks.items():
+            path = self._chunk_path(key)
+            if chunk is None:
+                if os.path.exists(path):
+                    os.remove(path)
+                continue
+            with open(path + ".tmp", "wb") as f:
+                np.save(f, chunk)
+            os.replace(path + ".tmp", path)
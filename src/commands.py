@@ -2,20 +2,44 @@
 Define a few command handlers.
 These usually take the two arguments update and context.
 """
-from telegram import ForceReply, Update
+import asyncio
+from pathlib import Path
+from telegram import ForceReply, Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes
 from time import time, gmtime, strftime
 import numpy as np
-from src.architect import Architect
-from src.place import Place
+from src.architect import get_architect
+from src.place import get_place_async, get_canvas_names, VIEW_SIZE
+from src.async_storage import get_async_store
+from src.locks import LOCKS, user_key
+from src.outbox import reply_text, reply_html, reply_photo, reply_video, edit_text
+from src.timelapse import export_timelapse_async
+from src.metrics import timed
 from scripts.utils import show_interaction
+from scripts.interaction_log import start_interaction
 from scripts.utils import get_user_full_name, babbo_natale, get_user_id
 from src.admin_commands import ADMIN_COMMNADS, command_wrapper
 
 
 COMMANDS = dict()
+CALLBACKS = dict()  # pattern of the callback data -> handler of the inline keyboard buttons
 PLACING_TILE_POINTS = 1
 
+# the renders of a canvas still queued for a chat are replaced by the newest one
+# (see render_key; the errors and usage texts are never replaced)
+CANVAS_RENDER = "canvas"
+CANVAS_PNG = "canvas_png"
+CANVAS_TIMELAPSE = "canvas_timelapse"
+
+# callback data of the buttons of a canvas view: "place view [x] [y] [width] [height] [canvas]"
+# (at most 64 bytes: without the canvas if its name is too long)
+VIEW_CALLBACK = "place view"
+MAX_CALLBACK_DATA = 64
+# pan buttons: (label, dx, dy) in halves of the view
+PAN_BUTTONS = (("⬅️", -1, 0), ("⬇️", 0, -1), ("⬆️", 0, 1), ("➡️", 1, 0))
+# zoom buttons: (label, factor on the size of the view)
+ZOOM_BUTTONS = (("➖", 2.), ("➕", .5))
+
 CONSOLATION_PHRASES = ["Better luck next time!",
                        "You lost!",
                        "You lose!",
@@ -34,14 +58,16 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     usern_full_name = get_user_full_name(user)
 
-    Architect().add_user(user.id, usern_full_name)
+    architect = get_architect()
+    architect.add_user(user.id, usern_full_name)
+    await get_async_store(architect).save()
 
     text = f"Ciao {user.mention_html()}! " \
            f"Sono Omar2.0, il tuo assistente personale 🤖\n" \
            f"Dimmi cosa posso fare per te! 😺\n" \
            f"Scrivi /help per vedere i comandi disponibili 📚"
     show_interaction(update, text)
-    await update.message.reply_html(text, reply_markup=ForceReply(selective=True))
+    await reply_html(update, text, reply_markup=ForceReply(selective=True))
 
 
 @command_wrapper
@@ -53,18 +79,18 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = ("🖥 Commands: " + ", ".join(["/" + key for key in COMMANDS]) + "\n")
 
     # list of admin-only commands
-    admin_ids = Architect().get_admin_ids()
+    admin_ids = get_architect().get_admin_ids()
     if get_user_id(update) in admin_ids:
         text += "✨ Admin commands: " + ", ".join(["/" + key for key in ADMIN_COMMNADS]) + "\n"
 
     show_interaction(update, text)
-    await update.message.reply_text(text)
+    await reply_text(update, text)
 
 
 @command_wrapper
 async def babbo_natale_segreto_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Send a message when the command /babbo_natale_segreto is issued."""
-    architect = Architect()
+    architect = get_architect()
     _ = context.args
     santas = architect.get_santas()
     user_names = [architect.get_user_name(user_id) for user_id in santas]
@@ -84,41 +110,41 @@ async def babbo_natale_segreto_command(update: Update, context: ContextTypes.DEF
         architect.add_active_santa(this_user_id)
 
         show_interaction(update, text)
-        await update.message.reply_text(text)
+        await reply_text(update, text)
     else:
         text = 'Non fai parte dei Babbi Natale...'
         show_interaction(update, text)
-        await update.message.reply_text(text)
+        await reply_text(update, text)
 
 
 @command_wrapper
 async def get_users_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Send a message when the command /users is issued."""
-    architect = Architect()
+    architect = get_architect()
     _ = context.args
     users = [f'{architect.get_user_emoji(i)} {architect.get_user_name(i)}' for i in architect.user_info]
     text = "---👥 Utenti registrati 👥---\n"
     text += '\n'.join(users)
     show_interaction(update, text)
-    await update.message.reply_text(text)
+    await reply_text(update, text)
 
 
 @command_wrapper
 async def show_user_gems_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Send a message when the command /gems is issued."""
-    architect = Architect()
+    architect = get_architect()
     _ = context.args
     user_id = get_user_id(update)
     gems = architect.get_gems(user_id)
     text = f"🔹 You own {gems} gems 🔹"
     show_interaction(update, text)
-    await update.message.reply_text(text)
+    await reply_text(update, text)
 
 
 @command_wrapper
 async def random_user_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Send a message when the command /random_user is issued."""
-    architect = Architect()
+    architect = get_architect()
     _ = context.args
     user_info = architect.get_user_info()
     random_user_id = list(user_info.keys())[np.random.randint(len(user_info))]
@@ -126,60 +152,123 @@ async def random_user_command(update: Update, context: ContextTypes.DEFAULT_TYPE
     text = f"👥 Utenti registrati: {len(user_info)}\n"
     text += f"👤 Utente casuale: {emoji} {architect.get_user_name(random_user_id)}"
     show_interaction(update, text)
-    await update.message.reply_text(text)
+    await reply_text(update, text)
+
+
+def get_view_keyboard(place, x0, y0, x1, y1) -> InlineKeyboardMarkup:
+    """Pan and zoom buttons of the view (x0, y0), (x1, y1) of the canvas, only the ones that move it"""
+    width, height = x1 - x0, y1 - y0
+    x, y = x0 + width // 2, y0 + height // 2
+    pan = [(label, x + dx * max(1, width // 2), y + dy * max(1, height // 2), width, height)
+           for label, dx, dy in PAN_BUTTONS]
+    zoom = [(label, x, y, int(width * factor), int(height * factor)) for label, factor in ZOOM_BUTTONS]
+    keyboard = []
+    for views in (pan, zoom):
+        buttons = []
+        for label, vx, vy, w, h in views:
+            bounds = place.get_view_bounds(vx, vy, w, h)
+            if bounds != (x0, y0, x1, y1):
+                bx0, by0, bx1, by1 = bounds
+                w, h = bx1 - bx0, by1 - by0
+                data = f"{VIEW_CALLBACK} {bx0 + w // 2} {by0 + h // 2} {w} {h}"
+                if len(data) + len(place.canvas_name.encode()) <= MAX_CALLBACK_DATA:
+                    # the view stays on the canvas of the message, whoever clicks
+                    data += f" {place.canvas_name[:-len('.csv')]}"
+                buttons.append(InlineKeyboardButton(label, callback_data=data))
+        if buttons:
+            keyboard.append(buttons)
+    return InlineKeyboardMarkup(keyboard)
+
+
+def render_key(kind, place) -> str:
+    """Coalesce key of a render of the canvas: the users of a chat can be on different canvases"""
+    return f"{kind}-{place.canvas_name}"
+
+
+def render_place_view(place, x, y, width=VIEW_SIZE[0], height=VIEW_SIZE[1]):
+    """Text and buttons of the view of the canvas around (x, y):
+    the cost depends on the size of the view, not on the one of the canvas"""
+    text = place.render_view(x, y, width, height)
+    return text, get_view_keyboard(place, *place.get_view_bounds(x, y, width, height))
 
 
 @command_wrapper
 async def place_command(update: Update, context: ContextTypes.DEFAULT_TYPE, n_gems=1):
     """Send a message when the command /place is issued."""
-    architect = Architect()
+    architect = get_architect()
     user_id = update.effective_user.id
     canvas_name = architect.get_canvas_name(user_id)
-    place = Place(canvas_name=canvas_name)
+    place = await get_place_async(canvas_name)
     args = context.args
     text = ''
+    keyboard = None
     now = time()
 
-    if len(args) >= 2:
-        # coordinates
-        last_place_time = architect.get_last_place_time(user_id)
-        time_to_wait = 0
-
-        if last_place_time is not None:
-            time_to_wait = place.minutes_cooldown * 60 - now + last_place_time
+    if len(args) >= 1 and args[0] == 'view':
+        # a part of the canvas, with buttons to move around
+        coalesce_key = None
+        try:
+            x, y = int(args[1]), int(args[2])
+            width, height = (int(args[3]), int(args[4])) if len(args) >= 5 else VIEW_SIZE
+            text, keyboard = render_place_view(place, x, y, width, height)
+            coalesce_key = render_key(CANVAS_RENDER, place)
+        except (IndexError, ValueError):
+            text = "Usage: /place view [x] [y] [width] [height]"
+        show_interaction(update, text)
+        await reply_text(update, text, coalesce_key=coalesce_key, reply_markup=keyboard)
+    elif len(args) >= 2:
+        # coordinates: a user gets one placement at a time (the check and the placement
+        # have no await in between, so the canvas needs no lock)
+        async with LOCKS.hold(user_key(user_id)):
+            last_place_time = architect.get_last_place_time(user_id)
+            time_to_wait = 0
+
+            if last_place_time is not None:
+                time_to_wait = place.minutes_cooldown * 60 - now + last_place_time
+
+            if time_to_wait <= 0:
+                # place the pixel
+                coalesce_key = None
+                x = None
+                y = None
+                user_id = None
+                try:
+                    x = int(args[0])
+                    y = int(args[1])
+                    user_id = update.effective_user.id
+                    place.swap_pixel(x, y, user_id=user_id)
+                    with architect.batch():
+                        architect.set_last_place_time(user_id, now)
+                        architect.add_place_tiles_count(user_id)
+                        architect.increase_gems(user_id, n_gems)
+                    # a big canvas is shown only around the new tile
+                    if place.is_large():
+                        view, keyboard = render_place_view(place, x, y)
+                        text += view
+                    else:
+                        text += str(place)
+                    coalesce_key = render_key(CANVAS_RENDER, place)
+                except Exception as e:
+                    text = (f"{x} {y} {user_id}\n"
+                            f"{e}: I valori inseriti non sono validi!")
 
         if time_to_wait <= 0:
-            # place the pixel
-            x = None
-            y = None
-            user_id = None
-            try:
-                x = int(args[0])
-                y = int(args[1])
-                user_id = update.effective_user.id
-                place.swap_pixel(x, y, user_id=user_id)
-                architect.set_last_place_time(user_id, now)
-                architect.add_place_tiles_count(user_id)
-                architect.increase_gems(user_id, n_gems)
-                text += str(place)
-            except Exception as e:
-                text = (f"{x} {y} {user_id}\n"
-                        f"{e}: I valori inseriti non sono validi!")
-
+            # the writes run in the storage I/O thread, in order: wait for them
+            # without holding the lock, so that the next placements can be batched with these
+            await asyncio.gather(get_async_store(place).save(), get_async_store(architect).save())
             show_interaction(update, text)
-            await update.message.reply_text(text)
+            await reply_text(update, text, coalesce_key=coalesce_key, reply_markup=keyboard)
         else:
             # wait
             text += f'💤 mancano ancora {time_to_wait+1:.0f} secondi...\n'
             show_interaction(update, text)
             if update.message is not None:
-                await update.message.reply_text(text)
+                await reply_text(update, text)
             else:
                 await update.callback_query.answer(text)  # todo check
     elif len(args) == 1:
         if args[0] == 'stats':
             # show stats
-            architect = Architect()
             names, emojis, tiles = architect.get_tile_leaderboard()
 
             for i in range(len(names)):
@@ -187,7 +276,7 @@ async def place_command(update: Update, context: ContextTypes.DEFAULT_TYPE, n_ge
                 text += f'{emojis[i]} {names[i]}: {tiles[i]} tile{s}\n'
 
             show_interaction(update, text)
-            await update.message.reply_text(text)
+            await reply_text(update, text)
         elif args[0] == 'tiles':
             count = place.count_tiles()
             count = {k: v for k, v in sorted(count.items(), key=lambda item: item[1], reverse=True)}
@@ -198,36 +287,139 @@ async def place_command(update: Update, context: ContextTypes.DEFAULT_TYPE, n_ge
             for i in range(len(ids)):
                 text += f'{count[ids[i]]} {emojis[i]} {names[i]}\n'
             show_interaction(update, text)
-            await update.message.reply_text(text)
+            await reply_text(update, text)
+        elif args[0] == 'png':
+            # the canvas as an image, for the canvases too big for the text
+            png = place.get_png()
+            rows, cols = place.get_canvas_shape()
+            text = f'🖼 {place.canvas_name[:-len(".csv")]} {rows}x{cols}'
+            show_interaction(update, text)
+            await reply_photo(update, png, coalesce_key=render_key(CANVAS_PNG, place), caption=text)
+        elif args[0] == 'timelapse':
+            if not place.is_event_log():
+                text = "Il time-lapse non è disponibile: questo canvas non ha la cronologia delle mosse"
+                show_interaction(update, text)
+                await reply_text(update, text)
+            else:
+                path = await export_timelapse_async(place, architect.get_emoji_table())
+                text = f'🎞 {place.canvas_name[:-len(".csv")]}'
+                show_interaction(update, text)
+                await reply_video(update, Path(path), coalesce_key=render_key(CANVAS_TIMELAPSE, place), caption=text)
     else:
         # show canvas
         text += f'Piazza un emoji ogni {place.minutes_cooldown} minuti con /place [x] [y]\n'
         text += f'Sovrascrivi una tua casella per cancellarla\n'
         text += f'/place stats, /place tiles per vedere le statistiche\n'
-        text += str(place)
+        text += f'/place png per vedere il canvas come immagine, /place timelapse per rivederne la storia\n'
+        text += f'/place view [x] [y] [larghezza] [altezza] per vedere solo una parte del canvas\n'
+        if place.is_large():
+            rows, cols = place.get_canvas_shape()
+            view, keyboard = render_place_view(place, rows // 2, cols // 2)
+            text += view
+        else:
+            text += str(place)
         show_interaction(update, text)
         # todo AttributeError: 'NoneType' object has no attribute 'reply_text'
-        await update.message.reply_text(text)
+        await reply_text(update, text, coalesce_key=render_key(CANVAS_RENDER, place), reply_markup=keyboard)
+
+
+async def place_view_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """The buttons of a canvas view: the new view replaces the old one in the same message"""
+    query = update.callback_query
+    start_interaction()
+    with timed("command", "place_view_callback"):
+        args = query.data[len(VIEW_CALLBACK):].split()
+        try:
+            x, y, width, height = map(int, args[:4])
+            if len(args) > 4:
+                canvas_name = f"{args[4]}.csv"
+            else:
+                # the canvas name did not fit: the canvas of the user
+                canvas_name = get_architect().get_canvas_name(update.effective_user.id)
+        except (ValueError, KeyError):
+            canvas_name = None
+        # answered first, whatever happens next, or the button keeps loading
+        found = canvas_name in get_canvas_names()
+        await query.answer(None if found else "Canvas non trovato")
+        if not found:
+            return
+        place = await get_place_async(canvas_name)
+        text, keyboard = render_place_view(place, x, y, width, height)
+        show_interaction(update, text)
+        # fast clicks on the same message: only the last view is sent
+        await edit_text(update, text, coalesce_key=f"{CANVAS_RENDER}-{query.message.message_id}",
+                        reply_markup=keyboard)
 
 
 @command_wrapper
 async def leaderboard_command(update: Update, context: ContextTypes.DEFAULT_TYPE, length=5):
     """Send a message when the command /leaderboard is issued."""
-    architect = Architect()
+    architect = get_architect()
     _ = context.args
     names, emojis, points = architect.get_tile_leaderboard()
     text = "---🔹 Gems Leaderboard 🔹---\n"
     for i in range(len(names)):
         text += f'{points[i]:_>{length}} {emojis[i]} {names[i]} \n'
     show_interaction(update, text)
-    await update.message.reply_text(text)
+    await reply_text(update, text)
+
+
+def toss_coins(architect, user_id, bet, n_coins, multiplier, limit, chars) -> str:
+    """Check the bet, toss the coins and pay the player.
+    Runs inside a transaction, so it must not await."""
+
+    # check bet size
+    try:
+        bet = int(bet)
+    except ValueError:
+        # invalid bet
+        return f'{bet} is not a valid bet amount\n'
+
+    player_gems = architect.get_gems(user_id)
+
+    # check if the player has enough gems
+    if bet > player_gems:
+        return f'You have only {player_gems} gems 🔹\n'
+
+    # check if the bet is within the limit
+    if bet > limit:
+        return f'You can bet up to {limit} gems 🔹\n'
+
+    # check if the bet is positive
+    if bet <= 0:
+        return 'You must bet at least 1 gem 🔹\n'
+
+    # if bet went through:
+    price = bet * multiplier
+    s = '' if bet == 1 else 's'
+    text = f'💰 You bet {bet} gem{s} 🔹\n\n'
+    architect.decrease_gems(user_id, bet)
+
+    # toss the coins
+    coins = np.random.choice([0, 1], n_coins)
+    text += f'Coins: {" ".join([chars[i] for i in coins])}\n\n'
+
+    if sum(coins) == 0 or sum(coins) == n_coins:
+        # reward the player
+        architect.increase_gems(user_id, price)
+        text += f'🎉 Congrats! You won {price} gems 🔹 🎉\n'
+        text += f'💰 You now have {architect.get_gems(user_id)} gems 💰'
+    else:
+        if sum(coins) == 1 or sum(coins) == n_coins - 1:
+            phrase = "Almost there!"
+        elif sum(coins) == 0:
+            phrase = "Impressive! All tails..."
+        else:
+            phrase = np.random.choice(CONSOLATION_PHRASES)
+        text += f'💸 {phrase} 💸'
+    return text
 
 
 @command_wrapper
 async def play_coin_game(update: Update, context: ContextTypes.DEFAULT_TYPE, n_coins=5, multiplier=15, limit=100):
     """Toss n_coins straight heads to win gems."""
     args = context.args
-    architect = Architect()
+    architect = get_architect()
     user_id = get_user_id(update)
     chars = ["🟡", "🔵"]
 
@@ -241,63 +433,14 @@ async def play_coin_game(update: Update, context: ContextTypes.DEFAULT_TYPE, n_c
                 f'to win {multiplier} times the gems! 🔹\n')
         text += 'Usage: /gamble [n_gems]'
     else:
-
-        # check bet size
-        bet = args[0]
-        try:
-            bet = int(bet)
-        except ValueError:
-            # invalid bet
-            text = f'{bet} is not a valid bet amount\n'
-            show_interaction(update, text)
-            return await update.message.reply_text(text)
-
-        player_gems = architect.get_gems(get_user_id(update))
-
-        # check if the player has enough gems
-        if bet > player_gems:
-            text = f'You have only {player_gems} gems 🔹\n'
-            show_interaction(update, text)
-            return await update.message.reply_text(text)
-
-        # check if the bet is within the limit
-        if bet > limit:
-            text = f'You can bet up to {limit} gems 🔹\n'
-            show_interaction(update, text)
-            return await update.message.reply_text(text)
-
-        # check if the bet is positive
-        if bet <= 0:
-            text = 'You must bet at least 1 gem 🔹\n'
-            show_interaction(update, text)
-            return await update.message.reply_text(text)
-
-        # if bet went through:
-        price = bet * multiplier
-        s = '' if bet == 1 else 's'
-        text = f'💰 You bet {bet} gem{s} 🔹\n\n'
-        architect.decrease_gems(user_id, bet)
-
-        # toss the coins
-        coins = np.random.choice([0, 1], n_coins)
-        text += f'Coins: {" ".join([chars[i] for i in coins])}\n\n'
-
-        if sum(coins) == 0 or sum(coins) == n_coins:
-            # reward the player
-            text += f'🎉 Congrats! You won {price} gems 🔹 🎉\n'
-            text += f'💰 You now have {player_gems + price} gems 💰'
-            architect.increase_gems(user_id, price)
-        else:
-            if sum(coins) == 1 or sum(coins) == n_coins - 1:
-                phrase = "Almost there!"
-            elif sum(coins) == 0:
-                phrase = "Impressive! All tails..."
-            else:
-                phrase = np.random.choice(CONSOLATION_PHRASES)
-            text += f'💸 {phrase} 💸'
+        # bet and payout are a single atomic operation with a single save
+        async with LOCKS.hold(user_key(user_id)):
+            with architect.transaction(user_id):
+                text = toss_coins(architect, user_id, args[0], n_coins, multiplier, limit, chars)
+            await get_async_store(architect).save()
 
     show_interaction(update, text)
-    return await update.message.reply_text(text)
+    return await reply_text(update, text)
 
 
 def main():
@@ -314,6 +457,7 @@ def main():
 
     # canvas
     COMMANDS["place"] = place_command
+    CALLBACKS[f"^{VIEW_CALLBACK} "] = place_view_callback
     COMMANDS["leaderboard"] = leaderboard_command
 
     # santa
@@ -0,0 +1,131 @@
+"""
+Append-only event log of the placements on a canvas.
+
+<canvas>.events/
+    snapshot-000000.npy   the canvas at the start of segment 0
+    events-000000.bin     the placements after it, as EVENT_DTYPE records
+    snapshot-000001.npy   the canvas at the start of segment 1
+    ...
+A placement is one 40 bytes append. Every so often a snapshot is written and
+a new segment starts (compaction), so the startup reads the latest snapshot
+and replays only the tail of the log. The older segments are the history
+of the canvas (replays, audits, time-lapses): keep_segments limits how
+many of them are kept, the oldest are removed when a snapshot is written.
+"""
+import os
+import re
+import numpy as np
+
+
+EVENT_DTYPE = np.dtype([("time", "<f8"), ("user_id", "<i8"), ("x", "<i4"), ("y", "<i4"),
+                        ("old", "<i8"), ("new", "<i8")])
+
+_SNAPSHOT_PATTERN = re.compile(r"snapshot-(\d+)\.npy$")
+
+
+def make_events(records) -> np.ndarray:
+    """Array of events from (time, user_id, x, y, old, new) tuples"""
+    return np.array(records, dtype=EVENT_DTYPE)
+
+
+def apply_events(canvas, events):
+    """Apply the events to the canvas, in place. Vectorized:
+    only the last event of each cell is written."""
+    if len(events) == 0:
+        return canvas
+    cells = events["x"].astype(np.int64) * canvas.shape[1] + events["y"]
+    _, last = np.unique(cells[::-1], return_index=True)
+    last = len(events) - 1 - last
+    canvas[events["x"][last], events["y"][last]] = events["new"][last]
+    return canvas
+
+
+class EventLog:
+    """The snapshots and event segments of a canvas.
+    All the methods do blocking I/O: the Place calls them in the storage I/O thread."""
+
+    def __init__(self, path, keep_segments=None):
+        self.path = path
+        self.keep_segments = keep_segments  # older segments kept after a snapshot (None: all)
+        self.segment = None  # number of the segment events are appended to
+
+    def _snapshot_path(self, seq):
+        return os.path.join(self.path, f"snapshot-{seq:06d}.npy")
+
+    def _events_path(self, seq):
+        return os.path.join(self.path, f"events-{seq:06d}.bin")
+
+    def get_segments(self) -> list:
+        """Numbers of the snapshots on disk, oldest first"""
+        if not os.path.isdir(self.path):
+            return []
+        matches = (_SNAPSHOT_PATTERN.match(name) for name in os.listdir(self.path))
+        return sorted(int(match.group(1)) for match in matches if match)
+
+    def exists(self) -> bool:
+        return self.segment is not None or bool(self.get_segments())
+
+    def read_events(self, seq) -> np.ndarray:
+        """Events of a segment. A record cut by a crash while appending is dropped."""
+        path = self._events_path(seq)
+        if not os.path.exists(path):
+            return np.zeros(0, dtype=EVENT_DTYPE)
+        with open(path, "rb") as f:
+            data = f.read()
+        n_bytes = len(data) - len(data) % EVENT_DTYPE.itemsize
+        if n_bytes != len(data):
+            os.truncate(path, n_bytes)
+        return np.frombuffer(data[:n_bytes], dtype=EVENT_DTYPE).copy()
+
+    def load(self):
+        """Return the canvas (latest snapshot + its events) and the number of events replayed"""
+        seq = self.get_segments()[-1]
+        canvas = np.load(self._snapshot_path(seq))
+        events = self.read_events(seq)
+        self.segment = seq
+        return apply_events(canvas, events), len(events)
+
+    def append(self, events):
+        """Append the events to the current segment. A record torn by a failed
+        append is dropped first, and a failed append leaves nothing behind,
+        so that the events written after it (e.g. when it is tried again) stay aligned."""
+        if len(events):
+            data = memoryview(events.tobytes())
+            with open(self._events_path(self.segment), "ab", buffering=0) as f:
+                start = f.seek(0, os.SEEK_END)
+                start -= start % EVENT_DTYPE.itemsize
+                f.truncate(start)
+                try:
+                    while data:
+                        data = data[f.write(data):]
+                except OSError:
+                    f.truncate(start)
+                    raise
+
+    def write_snapshot(self, canvas):
+        """Compaction: store the canvas and start a new segment"""
+        os.makedirs(self.path, exist_ok=True)
+        segments = self.get_segments()
+        seq = segments[-1] + 1 if segments else 0
+        tmp_path = self._snapshot_path(seq) + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, np.asarray(canvas))
+        os.replace(tmp_path, self._snapshot_path(seq))
+        self.segment = seq
+        if self.keep_segments is not None:
+            for old in segments[:max(len(segments) - self.keep_segments, 0)]:
+                os.remove(self._snapshot_path(old))
+                if os.path.exists(self._events_path(old)):
+                    os.remove(self._events_path(old))
+
+    def get_history(self):
+        """The oldest snapshot on disk and all the events after it"""
+        segments = self.get_segments()
+        canvas = np.load(self._snapshot_path(segments[0]))
+        events = np.concatenate([self.read_events(seq) for seq in segments])
+        return canvas, events
+
+    def canvas_at(self, t) -> np.ndarray:
+        """The canvas as it was at time t (seconds since the epoch)"""
+        canvas, events = self.get_history()
+        return apply_events(canvas, events[events["time"] <= t])
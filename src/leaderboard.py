@@ -0,0 +1,35 @@
+"""
+Leaderboards kept sorted while the scores change,
+so that the top users are read without scanning all of them.
+"""
+from bisect import bisect_left, insort
+
+
+class Leaderboard:
+    """Users with a non-zero score, sorted from the highest score"""
+
+    def __init__(self):
+        self.scores = dict()
+        self._ranking = []  # sorted (-score, user_id)
+
+    def __len__(self):
+        return len(self._ranking)
+
+    def remove(self, user_id):
+        """Take the user out of the leaderboard"""
+        score = self.scores.pop(user_id, None)
+        if score is not None:
+            i = bisect_left(self._ranking, (-score, user_id))
+            del self._ranking[i]
+
+    def update(self, user_id, score):
+        """Set the score of a user (a zero score removes the user)"""
+        self.remove(user_id)
+        if score:
+            self.scores[user_id] = score
+            insort(self._ranking, (-score, user_id))
+
+    def top(self, k=None) -> list:
+        """Return the (user_id, score) of the k best users (all of them if k is None)"""
+        ranking = self._ranking if k is None else self._ranking[:k]
+        return [(user_id, -score) for score, user_id in ranking]
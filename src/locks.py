@@ -0,0 +1,57 @@
+"""
+Locks for concurrent update processing: the handlers of different users
+run in parallel, the ones that touch the same user wait for each other.
+A change with no await inside (e.g. a placement on a canvas) needs no lock:
+it is already atomic on the event loop.
+"""
+import asyncio
+from contextlib import asynccontextmanager
+
+
+def user_key(user_id):
+    return "user", user_id
+
+
+class LockManager:
+    """One asyncio.Lock per key, dropped when nobody holds or waits for it"""
+
+    def __init__(self):
+        self._locks = dict()  # key -> [lock, number of holders and waiters]
+
+    def __len__(self):
+        return len(self._locks)
+
+    def _ref(self, key) -> asyncio.Lock:
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        return entry[0]
+
+    def _unref(self, key):
+        entry = self._locks[key]
+        entry[1] -= 1
+        if entry[1] == 0:
+            del self._locks[key]
+
+    @asynccontextmanager
+    async def hold(self, *keys):
+        """Hold the locks of all the keys. They are always taken
+        in the same order, so that two handlers can't deadlock."""
+        keys = sorted(set(keys), key=repr)
+        referenced = []
+        acquired = []
+        try:
+            for key in keys:
+                lock = self._ref(key)
+                referenced.append(key)
+                await lock.acquire()
+                acquired.append(lock)
+            yield
+        finally:
+            for lock in reversed(acquired):
+                lock.release()
+            for key in reversed(referenced):
+                self._unref(key)
+
+
+# the locks of the whole process
+LOCKS = LockManager()
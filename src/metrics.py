@@ -0,0 +1,149 @@
+"""
+Performance metrics: counters, latency percentiles and errors
+of the commands and of the storage operations.
+Shown by the /stats_perf admin command and exported in the Prometheus text format.
+"""
+import os
+import asyncio
+import threading
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from time import perf_counter
+import numpy as np
+
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+# metric family -> (description, label name)
+FAMILIES = {"command": ("Time spent handling a command", "command"),
+            "storage": ("Time spent reading and writing the users and the canvases", "operation"),
+            "send": ("Time spent sending the replies, and waiting when Telegram asks to retry later", "event")}
+
+
+class Metrics:
+    """Latency samples (the last `max_samples` of each metric), counts and errors.
+    The storage operations are observed in the storage I/O thread: the lock
+    keeps the readers from iterating the tables while they change."""
+
+    def __init__(self, max_samples=1000):
+        self.max_samples = max_samples
+        self._lock = threading.Lock()
+        self.counts = defaultdict(int)
+        self.errors = defaultdict(int)
+        self.total_seconds = defaultdict(float)
+        self.samples = defaultdict(lambda: deque(maxlen=self.max_samples))
+
+    def observe(self, family, name, seconds, error=False):
+        """Record one operation"""
+        key = (family, name)
+        with self._lock:
+            self.counts[key] += 1
+            self.total_seconds[key] += seconds
+            self.samples[key].append(seconds)
+            if error:
+                self.errors[key] += 1
+
+    @contextmanager
+    def timed(self, family, name):
+        """Time the block, count it as an error if it raises"""
+        start = perf_counter()
+        error = False
+        try:
+            yield
+        except BaseException:
+            error = True
+            raise
+        finally:
+            self.observe(family, name, perf_counter() - start, error=error)
+
+    def get_quantiles(self, key) -> list:
+        """Latency quantiles (seconds) over the recent samples"""
+        with self._lock:
+            samples = np.array(self.samples[key])
+        return np.quantile(samples, QUANTILES).tolist()
+
+    def get_keys(self, family=None) -> list:
+        with self._lock:
+            keys = list(self.counts)
+        return sorted(key for key in keys if family is None or key[0] == family)
+
+    def summary(self) -> str:
+        """Human readable table, slowest p95 first"""
+        lines = []
+        for family in FAMILIES:
+            keys = self.get_keys(family)
+            if not keys:
+                continue
+            rows = [(key, self.get_quantiles(key)) for key in keys]
+            rows.sort(key=lambda row: row[1][1], reverse=True)
+            lines.append(f"--- {family} (n, err, p50/p95/p99 ms) ---")
+            for (_, name), (p50, p95, p99) in rows:
+                key = (family, name)
+                lines.append(f"{name}: {self.counts[key]}, {self.errors.get(key, 0)}, "
+                             f"{p50 * 1e3:.1f}/{p95 * 1e3:.1f}/{p99 * 1e3:.1f}")
+        return "\n".join(lines) if lines else "No data yet"
+
+    def to_prometheus(self) -> str:
+        """Return the metrics in the Prometheus text exposition format"""
+        lines = []
+        for family, (description, label) in FAMILIES.items():
+            keys = self.get_keys(family)
+            if not keys:
+                continue
+            metric = f"omar_{family}_seconds"
+            lines.append(f"# HELP {metric} {description}")
+            lines.append(f"# TYPE {metric} summary")
+            for key in keys:
+                name = key[1]
+                for q, value in zip(QUANTILES, self.get_quantiles(key)):
+                    lines.append(f'{metric}{{{label}="{name}",quantile="{q}"}} {value}')
+                lines.append(f'{metric}_count{{{label}="{name}"}} {self.counts[key]}')
+                lines.append(f'{metric}_sum{{{label}="{name}"}} {self.total_seconds[key]}')
+            lines.append(f"# TYPE omar_{family}_errors_total counter")
+            for key in keys:
+                lines.append(f'omar_{family}_errors_total{{{label}="{key[1]}"}} {self.errors.get(key, 0)}')
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        """Write the Prometheus text file (atomically, for the node exporter)"""
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(self.to_prometheus())
+        os.replace(tmp_path, path)
+
+
+# the metrics of the whole process
+METRICS = Metrics()
+
+_EXPORT_TASK = None
+
+
+def timed(family, name):
+    """Time a block with the process metrics"""
+    return METRICS.timed(family, name)
+
+
+async def _export_loop(path, interval):
+    while True:
+        await asyncio.sleep(interval)
+        METRICS.write_prometheus(path)
+
+
+async def start_metrics_export(path, interval=15.):
+    """Write the Prometheus text file every `interval` seconds"""
+    global _EXPORT_TASK
+    if _EXPORT_TASK is None:
+        _EXPORT_TASK = asyncio.create_task(_export_loop(path, interval))
+
+
+async def stop_metrics_export(path):
+    """Stop the periodic export and write the file one last time"""
+    global _EXPORT_TASK
+    if _EXPORT_TASK is not None:
+        _EXPORT_TASK.cancel()
+        try:
+            await _EXPORT_TASK
+        except asyncio.CancelledError:
+            pass
+        _EXPORT_TASK = None
+        METRICS.write_prometheus(path)
@@ -1,6 +1,8 @@
 from telegram import Update
 from telegram.ext import ContextTypes
 from scripts.utils import show_interaction, get_message_text, get_user_full_name, moderate
+from scripts.interaction_log import start_interaction
+from src.outbox import reply_text
 
 
 def reply_bot(user, text: str, user_id) -> str:
@@ -13,14 +15,15 @@ def reply_bot(user, text: str, user_id) -> str:
 
 async def reply(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """reply to the user message"""
+    start_interaction()
     user = update.effective_user
-    message_text = get_message_text(update)
+    message_text = moderate(get_message_text(update))
 
     if not hasattr(update.message, 'reply_text'):
         # if the user edits an old message, it registers as a None message
         pass
     else:
         user_id = user.id
-        reply_text = reply_bot(user, message_text, user_id)
-        show_interaction(update, reply_text)
-        await update.message.reply_text(reply_text)
+        text = moderate(reply_bot(user, message_text, user_id))
+        show_interaction(update, text)
+        await reply_text(update, text)
@@ -0,0 +1,241 @@
+"""
+Outbound message queue: every reply goes through the OUTBOX, which keeps the bot
+under the Telegram flood limits with a global and a per-chat token bucket,
+waits and retries when Telegram answers RetryAfter, and coalesces the canvas
+renders queued for the same chat (only the most recent one is sent).
+The handlers queue their replies and return: they never wait for the
+token buckets, so a busy chat does not hold up the updates of the others.
+"""
+import asyncio
+from collections import deque
+from datetime import timedelta
+from time import monotonic
+from telegram.error import RetryAfter
+from src.metrics import METRICS, timed
+
+
+# Telegram: about 30 messages per second in total, 1 per second in the same chat
+GLOBAL_RATE = 25.
+GLOBAL_BURST = 25
+CHAT_RATE = 1.
+CHAT_BURST = 3
+MAX_RETRIES = 3
+
+# idle chats kept before the oldest are forgotten
+MAX_IDLE_CHATS = 1000
+
+
+class TokenBucket:
+    """`rate` tokens per second, at most `capacity` stored.
+    Tokens are reserved in advance, so waiters are served in order without a lock."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = monotonic()
+
+    def _refill(self):
+        now = monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self) -> float:
+        """Take a token, return the seconds to wait before using it"""
+        self._refill()
+        self.tokens -= 1
+        return max(0., -self.tokens / self.rate)
+
+    def pause(self, seconds):
+        """No tokens for the next `seconds`"""
+        self._refill()
+        self.tokens = min(self.tokens, 0.) - seconds * self.rate
+
+    def is_full(self) -> bool:
+        self._refill()
+        return self.tokens >= self.capacity
+
+
+class _Item:
+    """A queued send, and the futures of the callers waiting for it"""
+
+    def __init__(self, send, coalesce_key, future):
+        self.send = send
+        self.coalesce_key = coalesce_key
+        self.futures = [future]
+        self.n_retries = 0
+
+
+class _Chat:
+    def __init__(self, rate, capacity):
+        self.bucket = TokenBucket(rate, capacity)
+        self.queue = deque()
+        self.worker = None
+
+
+def _log_failure(chat_id, future):
+    if not future.cancelled() and future.exception() is not None:
+        print(f">>> Could not send to chat {chat_id}: {future.exception()}")
+
+
+def _seconds(retry_after) -> float:
+    if isinstance(retry_after, timedelta):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+
+class Outbox:
+    """Send scheduler. send() queues a coroutine function that does the
+    actual request and returns its result once it has been sent."""
+
+    def __init__(self, rate=GLOBAL_RATE, burst=GLOBAL_BURST, chat_rate=CHAT_RATE,
+                 chat_burst=CHAT_BURST, max_retries=MAX_RETRIES):
+        self.bucket = TokenBucket(rate, burst)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.n_coalesced = 0
+        self._chats = dict()  # chat id -> _Chat
+
+    def _get_chat(self, chat_id) -> _Chat:
+        if chat_id not in self._chats:
+            if len(self._chats) >= MAX_IDLE_CHATS:
+                self._forget_idle_chats()
+            self._chats[chat_id] = _Chat(self.chat_rate, self.chat_burst)
+        return self._chats[chat_id]
+
+    def _forget_idle_chats(self):
+        """Drop the chats with nothing to send that are not rate limited anymore"""
+        for chat_id in [chat_id for chat_id, chat in self._chats.items()
+                        if chat.worker is None and chat.bucket.is_full()]:
+            del self._chats[chat_id]
+
+    def n_pending(self) -> int:
+        return sum(len(chat.queue) for chat in self._chats.values())
+
+    def queue(self, chat_id, send, coalesce_key=None) -> asyncio.Future:
+        """Queue `send` (a coroutine function without arguments) for the chat,
+        return the future of its result without waiting for it.
+        If a send with the same coalesce_key is still queued for the chat,
+        it is replaced by this one, and both callers get its result.
+        A failed send is logged, whether or not anyone awaits the future."""
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(lambda f: _log_failure(chat_id, f))
+        chat = self._get_chat(chat_id)
+        for item in chat.queue:
+            if coalesce_key is not None and item.coalesce_key == coalesce_key:
+                item.send = send
+                item.futures.append(future)
+                self.n_coalesced += 1
+                break
+        else:
+            chat.queue.append(_Item(send, coalesce_key, future))
+        if chat.worker is None:
+            chat.worker = asyncio.create_task(self._drain(chat))
+        return future
+
+    async def send(self, chat_id, send, coalesce_key=None):
+        """queue() and wait until it is sent, return the result"""
+        return await self.queue(chat_id, send, coalesce_key)
+
+    async def join(self):
+        """Wait until everything queued so far is sent (or failed)"""
+        while True:
+            workers = [chat.worker for chat in self._chats.values() if chat.worker is not None]
+            if not workers:
+                return
+            await asyncio.wait(workers)
+
+    async def _drain(self, chat: _Chat):
+        """Send the queue of a chat, one message at a time"""
+        try:
+            while chat.queue:
+                await asyncio.sleep(chat.bucket.reserve())
+                await asyncio.sleep(self.bucket.reserve())
+                # out of the queue while it is sent, so nothing is coalesced into it
+                item = chat.queue.popleft()
+                try:
+                    with timed("send", "request"):
+                        result = await item.send()
+                except RetryAfter as e:
+                    # flood limit: stop sending to this chat for a while, then retry
+                    seconds = _seconds(e.retry_after)
+                    METRICS.observe("send", "retry_after", seconds)
+                    chat.bucket.pause(seconds)
+                    item.n_retries += 1
+                    if item.n_retries <= self.max_retries:
+                        chat.queue.appendleft(item)
+                    else:
+                        self._resolve(item, exception=e)
+                except Exception as e:
+                    self._resolve(item, exception=e)
+                else:
+                    self._resolve(item, result=result)
+        finally:
+            chat.worker = None
+            while chat.queue:
+                # the worker was cancelled
+                for future in chat.queue.popleft().futures:
+                    future.cancel()
+
+    @staticmethod
+    def _resolve(item: _Item, result=None, exception=None):
+        for future in item.futures:
+            if future.done():
+                continue  # the caller gave up
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(result)
+
+
+# the send scheduler of the whole process
+OUTBOX = Outbox()
+
+
+def configure_outbox(**kwargs) -> Outbox:
+    """Replace the OUTBOX with one with other limits (see Outbox)"""
+    global OUTBOX
+    OUTBOX = Outbox(**kwargs)
+    return OUTBOX
+
+
+def _get_chat_id(update):
+    chat = getattr(update, "effective_chat", None)
+    return chat.id if chat is not None else update.effective_user.id
+
+
+async def reply_text(update, text, coalesce_key=None, **kwargs):
+    """update.message.reply_text through the OUTBOX. Returns once queued:
+    await the returned future to wait for the sent Message."""
+    message = update.message
+    return OUTBOX.queue(_get_chat_id(update), lambda: message.reply_text(text, **kwargs),
+                        coalesce_key=coalesce_key)
+
+
+async def reply_html(update, text, coalesce_key=None, **kwargs):
+    """update.message.reply_html through the OUTBOX"""
+    message = update.message
+    return OUTBOX.queue(_get_chat_id(update), lambda: message.reply_html(text, **kwargs),
+                        coalesce_key=coalesce_key)
+
+
+async def reply_photo(update, photo, coalesce_key=None, **kwargs):
+    """update.message.reply_photo through the OUTBOX"""
+    message = update.message
+    return OUTBOX.queue(_get_chat_id(update), lambda: message.reply_photo(photo, **kwargs),
+                        coalesce_key=coalesce_key)
+
+
+async def reply_video(update, video, coalesce_key=None, **kwargs):
+    """update.message.reply_video through the OUTBOX"""
+    message = update.message
+    return OUTBOX.queue(_get_chat_id(update), lambda: message.reply_video(video, **kwargs),
+                        coalesce_key=coalesce_key)
+
+
+async def edit_text(update, text, coalesce_key=None, **kwargs):
+    """update.callback_query.edit_message_text through the OUTBOX"""
+    query = update.callback_query
+    return OUTBOX.queue(_get_chat_id(update), lambda: query.edit_message_text(text, **kwargs),
+                        coalesce_key=coalesce_key)
@@ -1,14 +1,72 @@
 import numpy as np
 import os
-from src.architect import Architect
+import re
+from time import time
+from functools import partial
+from src.architect import get_architect
+from src.write_behind import get_flusher
+from src.metrics import timed
+from src.async_storage import get_async_store, run_io
+from src.canvas_image import CanvasImage, MAX_IMAGE_SIDE
+from src.event_log import EventLog, make_events
+from src.chunks import ChunkedGrid
 
 
 PLACE_DIR = "data/canvases"
 
+# "csv" (text, rewritten on every save), "npy" (binary, memory-mapped and updated in place)
+# "log" (snapshot + append-only log of the placements, see src/event_log.py)
+# or "chunks" (sparse, only the touched 64x64 chunks are stored, see src/chunks.py)
+CANVAS_FORMAT = "csv"
+CANVAS_FORMATS = ("csv", "npy", "log", "chunks")
+
+# canvases with more tiles are shown as a view around some coordinates instead of as a whole
+MAX_TEXT_TILES = 1000
+# size of the view (columns and lines of the message), by default and at most
+VIEW_SIZE = (16, 16)
+MAX_VIEW_SIDE = 40
+
+# placements appended to the event log before a new snapshot is written
+SNAPSHOT_EVERY = 1000
+# older segments of the event log kept after a snapshot (None: all the history)
+KEEP_SEGMENTS = None
+
+# the canvases created by the admins: name (no path separators) and size at most
+CANVAS_NAME_PATTERN = re.compile(r"[\w-]+$")
+MAX_CANVAS_SIDE = 100_000
+
+# canvases shared by all the handlers (by canvas name), so that they are
+# read from disk only once and pending changes are never lost
+_PLACES = dict()
+
+# the grid holds indices in the palette of the canvas, in the smallest of these types
+GRID_DTYPES = (np.uint8, np.uint16, np.uint32)
+
+
+def get_grid_dtype(n_colors):
+    """Smallest dtype that can index a palette of n_colors"""
+    for dtype in GRID_DTYPES:
+        if n_colors <= np.iinfo(dtype).max + 1:
+            return dtype
+    raise ValueError(f"Palette too big: {n_colors}")
+
+
+def to_palette(canvas):
+    """Split a grid of user ids into the palette (user ids, 0 first) and the grid of indices"""
+    canvas = np.asarray(canvas)
+    mask = canvas != 0
+    user_ids = np.unique(canvas[mask])
+    palette = np.concatenate([[0], user_ids]).astype(np.int64)
+    grid = np.zeros(canvas.shape, dtype=get_grid_dtype(len(palette)))
+    grid[mask] = np.searchsorted(user_ids, canvas[mask]) + 1
+    return palette, grid
+
 
 class Place:
-    def __init__(self, canvas_name="default.csv", shape=(14, 20), minutes_cooldown=3):
+    def __init__(self, canvas_name="default.csv", shape=(14, 20), minutes_cooldown=3, canvas_format=None,
+                 new=False):
         self.minutes_cooldown = minutes_cooldown
+        self.canvas_format = CANVAS_FORMAT if canvas_format is None else canvas_format
         self.canvas_name = canvas_name
         if not canvas_name.endswith(".csv"):
             self.canvas_name += ".csv"
@@ -16,30 +74,359 @@ class Place:
         self.digits = ["0️⃣", "1️⃣", "2️⃣", "3️⃣", "4️⃣",
                        "5️⃣", "6️⃣", "7️⃣", "8️⃣", "9️⃣"]
         self.origin_character = "🌠"
-        self.canvas = None  # contains the player ids
-        self.load_canvas(shape)
+        self.grid = None  # index in the palette of the player of each tile
+        self.palette = None  # user ids of the players on the canvas, 0 (empty tile) first
+        self._palette_index = None  # {user_id: index in the palette}
+        self._palette_dirty = False  # palette changed since the last write (npy format)
+        self._grid_rewrite = False  # npy format: the grid in memory must replace the file (see _rewrite_binary)
+        self.dirty = False  # canvas changed since the last write
+        self.mtime = None  # modification time of the file when last read or written
+        self.flusher = None  # writes the changes: WriteBehindFlusher or AsyncStore
+        self._writes_in_flight = 0
+        self._lines = None  # cached text of each line of the canvas, patched by swap_pixel
+        self._text = None  # cached text of the whole canvas
+        self._emoji_version = None  # Architect.emoji_version the cache was rendered with
+        self._emojis = None  # emoji of each user of the palette, see _get_emojis
+        self._emojis_version = None  # Architect.emoji_version of the emojis
+        self._tile_counts = None  # {user_id: tiles on the canvas}, kept up to date by swap_pixel
+        self._image = None  # CanvasImage, its tiles are drawn again after swap_pixel
+        self._image_window = None  # (x0, y0, x1, y1) part of the canvas in the image
+        self.event_log = EventLog(self.get_log_dir(), keep_segments=KEEP_SEGMENTS) if self.is_event_log() else None
+        self._events = []  # placements not yet appended to the event log
+        self._segment_size = 0  # placements in the current segment of the event log
+        self._snapshot_due = False  # write a snapshot with the next events
+        if new:
+            # an empty canvas, whatever is on disk
+            self.reset_canvas(shape)
+        else:
+            self.load_canvas(shape)
 
     def get_path(self):
         return os.path.join(PLACE_DIR, f"{self.canvas_name}")
 
+    def get_binary_path(self):
+        """The .npy file (header with version, dtype and shape + raw grid of palette indices)"""
+        return os.path.join(PLACE_DIR, f"{self.canvas_name[:-len('.csv')]}.npy")
+
+    def get_palette_path(self):
+        """The .npy file of the palette (int64 user ids) of the binary or chunked grid"""
+        if self.is_chunked():
+            return os.path.join(self.get_chunks_dir(), "palette.npy")
+        return os.path.join(PLACE_DIR, f"{self.canvas_name[:-len('.csv')]}.palette.npy")
+
+    def _get_rewrite_paths(self):
+        """The grid and palette files written aside by _rewrite_binary"""
+        return self.get_binary_path() + ".rewrite", self.get_palette_path() + ".rewrite"
+
+    def get_chunks_dir(self):
+        """The directory of the chunks of the sparse grid"""
+        return get_chunks_dir(self.canvas_name)
+
+    @property
+    def canvas(self) -> np.ndarray:
+        """The user id of each tile (a new array)"""
+        return self.palette[self.grid]
+
+    def _set_canvas(self, canvas):
+        """Replace the whole canvas with a grid of user ids"""
+        self._set_palette(*to_palette(canvas))
+
+    def _set_palette(self, palette, grid):
+        self.palette = palette
+        self.grid = grid
+        self._palette_index = {user_id: i for i, user_id in enumerate(palette.tolist())}
+        self._image = None
+        self._emojis = None
+
+    def get_log_dir(self):
+        """The directory of the snapshots and of the event log"""
+        return os.path.join(PLACE_DIR, f"{self.canvas_name[:-len('.csv')]}.events")
+
+    def is_binary(self) -> bool:
+        return self.canvas_format == "npy"
+
+    def is_event_log(self) -> bool:
+        return self.canvas_format == "log"
+
+    def is_chunked(self) -> bool:
+        return self.canvas_format == "chunks"
+
+    def get_file_path(self):
+        """The file that holds the canvas in the current format"""
+        if self.is_event_log():
+            return self.get_log_dir()
+        if self.is_chunked():
+            return self.get_chunks_dir()
+        return self.get_binary_path() if self.is_binary() else self.get_path()
+
+    def _get_file_mtime(self):
+        try:
+            return os.stat(self.get_file_path()).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def is_stale(self) -> bool:
+        """True if the file was changed on disk (e.g. by an admin) after it was last read or written"""
+        mtime = self._get_file_mtime()
+        return not self.dirty and not self._writes_in_flight and mtime is not None and mtime != self.mtime
+
+    @staticmethod
+    def read_csv(path):
+        """Return the canvas stored in a CSV file"""
+        with open(path, "r", encoding='utf-8') as f:
+            v = [list(map(int, line.strip().split(','))) for line in f]
+            return np.array(v, dtype=np.int64)
+
     def read_canvas(self):
         """Read the canvas info from a file"""
+        self.apply_state(self.read_state())
+
+    def read_state(self):
+        """Read the canvas from the files, without changing the Place, so that
+        it can run in the I/O thread while the handlers use the Place (see apply_state).
+        Return the palette, the grid, the events in the log and the mtime of the file."""
         print(f'Reading canvas "{self.canvas_name}" from file...')
 
-        with open(self.get_path(), "r", encoding='utf-8') as f:
-            v = [list(map(int, line.strip().split(','))) for line in f]
-            self.canvas = np.array(v, dtype=np.int64)
+        n_events = None
+        with timed("storage", "place_read"):
+            if self.is_binary():
+                self._finish_rewrite()
+                if not os.path.exists(self.get_binary_path()):
+                    self.import_csv()
+                elif not os.path.exists(self.get_palette_path()):
+                    # grid of user ids written by an older version
+                    self._write_binary(*to_palette(np.load(self.get_binary_path())))
+                palette = np.load(self.get_palette_path())
+                grid = np.lib.format.open_memmap(self.get_binary_path(), mode='r+')
+                if len(grid) and grid.max() >= len(palette):
+                    # crash between the writes of the grid and of the palette: drop the unknown tiles
+                    grid[grid >= len(palette)] = 0
+            elif self.is_event_log():
+                if not self.event_log.exists():
+                    self.event_log.write_snapshot(self.read_csv(self.get_path()))
+                canvas, n_events = self.event_log.load()
+                palette, grid = to_palette(canvas)
+            elif self.is_chunked():
+                if not os.path.isdir(self.get_chunks_dir()):
+                    self._write_chunks(*to_palette(self.read_csv(self.get_path())))
+                # only the list of the chunks is read here, the chunks are read when needed
+                grid = ChunkedGrid.open(self.get_chunks_dir())
+                palette = np.load(self.get_palette_path())
+            else:
+                palette, grid = to_palette(self.read_csv(self.get_path()))
+        return palette, grid, n_events, self._get_file_mtime()
 
-    def save_canvas(self):
-        """Save the canvas by overwriting the file"""
-        with open(self.get_path(), "w", encoding='utf-8') as f:
-            for row in self.canvas:
+    def apply_state(self, state):
+        """Replace the canvas with the one read by read_state"""
+        palette, grid, n_events, mtime = state
+        self._set_palette(palette, grid)
+        if n_events is not None:
+            self._segment_size = n_events
+            self._events = []
+        self.mtime = mtime
+        self._lines = None
+        self._tile_counts = None
+        self._image = None
+
+    def import_csv(self, path=None):
+        """Convert a CSV canvas (by default the one with the same name) to the binary format"""
+        canvas = self.read_csv(self.get_path() if path is None else path)
+        self._write_binary(*to_palette(canvas))
+
+    def _write_palette(self, palette):
+        tmp_path = self.get_palette_path() + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, palette)
+        os.replace(tmp_path, self.get_palette_path())
+
+    def _write_binary(self, palette, grid):
+        """Write the palette and the grid files of the binary format"""
+        self._write_palette(palette)
+        np.save(self.get_binary_path(), grid)
+
+    def _rewrite_binary(self, palette, grid):
+        """Replace the grid file (with another dtype or palette) and the palette file.
+        Both are written aside first, then the grid is replaced and the palette last:
+        _finish_rewrite completes or drops a rewrite cut by a crash."""
+        grid_path, palette_path = self._get_rewrite_paths()
+        with open(grid_path, "wb") as f:
+            np.save(f, grid)
+        with open(palette_path, "wb") as f:
+            np.save(f, palette)
+        os.replace(grid_path, self.get_binary_path())
+        os.replace(palette_path, self.get_palette_path())
+
+    def _finish_rewrite(self):
+        """After a crash during _rewrite_binary: if the grid was replaced, replace the palette too"""
+        grid_path, palette_path = self._get_rewrite_paths()
+        if os.path.exists(grid_path):
+            # the old grid and palette are still in place
+            os.remove(grid_path)
+            if os.path.exists(palette_path):
+                os.remove(palette_path)
+        elif os.path.exists(palette_path):
+            os.replace(palette_path, self.get_palette_path())
+
+    def _write_chunks(self, palette, grid):
+        """Write the palette and the non-empty chunks of a (dense) grid in the chunked format"""
+        chunks = ChunkedGrid.from_array(self.get_chunks_dir(), grid)
+        os.makedirs(self.get_chunks_dir(), exist_ok=True)
+        self._write_palette(palette)
+        chunks.write_dirty(chunks.take_dirty(), chunks.get_meta())
+
+    @staticmethod
+    def write_csv(path, canvas):
+        """Write a canvas to a CSV file"""
+        with open(path, "w", encoding='utf-8') as f:
+            for row in canvas:
                 s = ','.join(map(str, row))
                 f.write(f'{s}\n')
 
+    def export_csv(self, path=None):
+        """Write the canvas as CSV (by default to the file with the same name)"""
+        self.write_csv(self.get_path() if path is None else path, self.canvas)
+
+    def load(self):
+        """Read the canvas from disk again"""
+        self.read_canvas()
+
+    def save_canvas(self):
+        """Save the canvas, or leave it to the flusher in write-behind mode"""
+        self.dirty = True
+        if self.flusher is not None:
+            self.flusher.notify(self)
+        else:
+            self.flush()
+
+    def n_pending(self) -> int:
+        """Number of changes not yet on disk"""
+        if self.is_event_log():
+            return len(self._events) + int(self._snapshot_due)
+        return int(self.dirty)
+
+    def take_pending(self):
+        """Detach a copy of the canvas, so that another thread can write it
+        (nothing to copy for the memory map, it is already up to date).
+        With the event log: the new events, and a copy of the canvas when a snapshot is due.
+        With the chunks: copies of the changed chunks only.
+        In npy format, after _compact_palette: a copy of the grid, to replace the file."""
+        if self.is_binary() and not self._grid_rewrite and not self._writes_in_flight \
+                and not isinstance(self.grid, np.memmap):
+            # the rewritten file is on disk: back to the memory map
+            grid = np.lib.format.open_memmap(self.get_binary_path(), mode='r+')
+            grid[...] = self.grid
+            self.grid = grid
+        self.dirty = False
+        self._writes_in_flight += 1
+        if self.is_binary() or self.is_chunked():
+            palette = self.palette.copy() if self._palette_dirty else None
+            self._palette_dirty = False
+            if self.is_chunked():
+                return palette, self.grid.take_dirty(), self.grid.get_meta()
+            grid = None
+            if self._grid_rewrite:
+                grid = self.grid.copy()
+                palette = self.palette.copy()
+                self._grid_rewrite = False
+            return palette, grid
+        if self.is_event_log():
+            events = make_events(self._events)
+            self._events = []
+            self._segment_size += len(events)
+            snapshot = None
+            if self._snapshot_due or self._segment_size >= SNAPSHOT_EVERY:
+                snapshot = self.canvas
+                self._snapshot_due = False
+                self._segment_size = 0
+            return events, snapshot
+        return self.canvas
+
+    def write_pending(self, canvas):
+        """Write the canvas: only the changed pages of the memory map
+        in binary format, the new events in event log format,
+        the changed chunks in chunked format, the whole file in CSV format"""
+        try:
+            with timed("storage", "place_save"):
+                if self.is_chunked():
+                    palette, chunks, meta = canvas
+                    os.makedirs(self.get_chunks_dir(), exist_ok=True)
+                    if palette is not None:
+                        self._write_palette(palette)
+                    self.grid.write_dirty(chunks, meta)
+                elif self.is_binary():
+                    palette, grid = canvas
+                    if grid is not None:
+                        self._rewrite_binary(palette, grid)
+                    else:
+                        # the palette first: the grid may already use its new colors
+                        if palette is not None:
+                            self._write_palette(palette)
+                        grid = self.grid
+                        if isinstance(grid, np.memmap):
+                            grid.flush()
+                elif self.is_event_log():
+                    events, snapshot = canvas
+                    if self.event_log.exists():
+                        self.event_log.append(events)
+                    if snapshot is not None:
+                        # the snapshot already contains the events
+                        self.event_log.write_snapshot(snapshot)
+                else:
+                    self.write_csv(self.get_path(), canvas)
+            self.mtime = self._get_file_mtime()
+        finally:
+            self._writes_in_flight -= 1
+
+    def restore_pending(self, canvas):
+        """The write of what take_pending detached failed: make it pending again.
+        The canvas in memory is newer than the detached copy, only the events
+        (and what the formats write incrementally) must be put back."""
+        self.dirty = True
+        if self.is_binary() or self.is_chunked():
+            if canvas[0] is not None:
+                self._palette_dirty = True
+            if self.is_chunked():
+                self.grid.dirty_chunks.update(canvas[1])
+            elif canvas[1] is not None:
+                self._grid_rewrite = True
+        elif self.is_event_log():
+            events, snapshot = canvas
+            # before the events of the placements made meanwhile
+            self._events = events.tolist() + self._events
+            if snapshot is not None:
+                self._snapshot_due = True
+            else:
+                self._segment_size -= len(events)
+
+    def compact(self):
+        """Event log: write a snapshot with the next save, which starts a new segment
+        and removes the segments beyond the retention (KEEP_SEGMENTS)"""
+        if self.is_event_log():
+            self._snapshot_due = True
+            self.save_canvas()
+
+    def flush(self):
+        """Write the canvas to disk"""
+        self.write_pending(self.take_pending())
+
     def reset_canvas(self, shape):
         """Reset the canvas to zeros"""
-        self.canvas = np.zeros(shape, dtype=np.int64)
+        if self.is_binary():
+            self._write_palette(np.zeros(1, dtype=np.int64))
+            grid = np.lib.format.open_memmap(self.get_binary_path(), mode='w+',
+                                             dtype=GRID_DTYPES[0], shape=tuple(shape))
+            self._set_palette(np.zeros(1, dtype=np.int64), grid)
+        elif self.is_chunked():
+            grid = ChunkedGrid(self.get_chunks_dir(), shape, dtype=GRID_DTYPES[0])
+            self._set_palette(np.zeros(1, dtype=np.int64), grid)
+            self._palette_dirty = True
+        else:
+            self._set_canvas(np.zeros(shape, dtype=np.int64))
+        if self.is_event_log():
+            self._snapshot_due = True
+        self._lines = None
+        self._tile_counts = None
+        self._image = None
         self.save_canvas()
 
     def load_canvas(self, shape):
@@ -53,45 +440,286 @@ class Place:
 
     def get_canvas_shape(self):
         """Return the shape of the canvas"""
-        return self.canvas.shape
+        return self.grid.shape
 
-    def swap_pixel(self, x, y, user_id):
-        """Swap the tile at the given coordinates"""
+    def _clip(self, x, y):
+        """Bring the coordinates inside the canvas (negative ones count from the end)"""
         rows, cols = self.get_canvas_shape()
-        x = np.clip(x, -rows, rows - 1)
-        y = np.clip(y, -cols, cols - 1)
-        if self.canvas[x][y] == user_id:
-            self.canvas[x][y] = 0
-        else:
-            self.canvas[x][y] = user_id
+        return int(np.clip(x, -rows, rows - 1)) % rows, int(np.clip(y, -cols, cols - 1)) % cols
+
+    def get_item(self, x, y):
+        """Return the id of the user that owns the tile (0 if empty)"""
+        x, y = self._clip(x, y)
+        return int(self.palette[self.grid[x, y]])
+
+    def set_item(self, x, y, user_id, author=None):
+        """Give the tile to a user (0 to empty it).
+        The event log records the author of the change (by default user_id)."""
+        x, y = self._clip(x, y)
+        old_id = int(self.palette[self.grid[x, y]])
+        self.grid[x, y] = self._get_palette_index(user_id)
+        if self.is_event_log():
+            self._events.append((time(), user_id if author is None else author, x, y, old_id, user_id))
+        self._update_tile_counts(old_id, user_id)
+        self._patch_line(y)
+        if self._image is not None:
+            x0, y0, x1, y1 = self._image_window
+            if x0 <= x < x1 and y0 <= y < y1:
+                self._image.mark_dirty(x - x0, y - y0)
         self.save_canvas()
 
+    def _get_palette_index(self, user_id) -> int:
+        """Index of the user in the palette, added if missing"""
+        index = self._palette_index.get(user_id)
+        if index is None:
+            if len(self.palette) > np.iinfo(self.grid.dtype).max:
+                self._compact_palette()
+            index = len(self.palette)
+            self.palette = np.append(self.palette, np.int64(user_id))
+            self._palette_index[user_id] = index
+            self._palette_dirty = True
+        return index
+
+    def _compact_palette(self):
+        """Drop the users without tiles from the full palette,
+        and use a wider grid type if it is still full"""
+        used = np.union1d([0], self.grid.unique() if self.is_chunked() else np.unique(self.grid))
+        remap = np.zeros(len(self.palette), dtype=np.int64)
+        remap[used] = np.arange(len(used))
+        palette = self.palette[used]
+        dtype = get_grid_dtype(len(palette) + 1)
+        if self.is_chunked():
+            # all the chunks are written again
+            self.grid.remap(remap, dtype)
+            grid = self.grid
+        elif self.is_binary():
+            # in memory until the next write replaces the files (the memory map can't be
+            # resized, and no I/O is done here, in the handler)
+            grid = remap[self.grid].astype(dtype)
+            self._grid_rewrite = True
+        else:
+            grid = remap[self.grid].astype(dtype)
+        self._set_palette(palette, grid)
+        self._palette_dirty = True
+
+    def swap_pixel(self, x, y, user_id):
+        """Swap the tile at the given coordinates"""
+        new_id = 0 if self.get_item(x, y) == user_id else user_id
+        self.set_item(x, y, new_id, author=user_id)
+
+    def _update_tile_counts(self, old_id, new_id):
+        """Move one tile from old_id to new_id in the tile index"""
+        if self._tile_counts is None or old_id == new_id:
+            return
+        if old_id != 0:
+            self._tile_counts[old_id] -= 1
+            if self._tile_counts[old_id] == 0:
+                del self._tile_counts[old_id]
+        if new_id != 0:
+            self._tile_counts[new_id] = self._tile_counts.get(new_id, 0) + 1
+
     def count_tiles(self):
         """Return a dictionary with the number of tiles for each user"""
-        rows, cols = self.get_canvas_shape()
-        count = dict()
-        for i in range(rows):
-            for j in range(cols):
-                user_id = self.canvas[i][j]
-                if user_id != 0:
-                    count[user_id] = count.get(user_id, 0) + 1
-        return count
+        if self._tile_counts is None:
+            if self.is_chunked():
+                counts = self.grid.bincount(minlength=len(self.palette))
+            else:
+                counts = np.bincount(np.ravel(self.grid), minlength=len(self.palette))
+            self._tile_counts = {user_id: n for user_id, n in zip(self.palette.tolist(), counts.tolist())
+                                 if user_id != 0 and n > 0}
+        return dict(self._tile_counts)
+
+    def _render_line(self, j, emoji_table) -> str:
+        """Return the text of the j-th column of the canvas (a line of the message)"""
+        cells = [self.default_char if user_id == 0 else emoji_table.get(user_id, self.default_char)
+                 for user_id in self.palette[self.grid[:, j]].tolist()]
+        return self.digits[j % 10] + "".join(cells)
+
+    def _get_emojis(self, emoji_table, emoji_version) -> np.ndarray:
+        """The emoji of each user of the palette. Cached: only the users added
+        to the palette are looked up, unless the emojis changed."""
+        if self._emojis_version != emoji_version:
+            self._emojis_version = emoji_version
+            self._emojis = None
+        n = 0 if self._emojis is None else len(self._emojis)
+        if n < len(self.palette):
+            emojis = np.array([self.default_char if user_id == 0 else emoji_table.get(user_id, self.default_char)
+                               for user_id in self.palette[n:].tolist()], dtype=object)
+            self._emojis = emojis if n == 0 else np.concatenate([self._emojis, emojis])
+        return self._emojis
+
+    def _render_lines(self, emoji_table):
+        """Render all the lines, looking up the emoji of each user of the palette only once"""
+        cells = self._get_emojis(emoji_table, self._emoji_version)[np.asarray(self.grid)]
+        self._lines = [self.digits[j % 10] + "".join(cells[:, j]) for j in range(cells.shape[1])]
+        self._text = None
+
+    def _patch_line(self, j):
+        """Render again only the line that contains the changed tile"""
+        if self._lines is not None:
+            self._lines[j] = self._render_line(j, get_architect().get_emoji_table())
+            self._text = None
 
     def __repr__(self):
         """Return a string representation of the canvas"""
-        architect = Architect()
+        architect = get_architect()
+        if self._lines is None or self._emoji_version != architect.emoji_version:
+            self._emoji_version = architect.emoji_version
+            self._render_lines(architect.get_emoji_table())
+        if self._text is None:
+            rows, cols = self.get_canvas_shape()
+            footer = self.origin_character + "".join(self.digits[i % 10] for i in range(rows))
+            self._text = "\n".join(reversed(self._lines)) + "\n" + footer
+        return self._text
+
+    def is_large(self) -> bool:
+        """True if the canvas is too big to be sent as text (see render_view)"""
         rows, cols = self.get_canvas_shape()
-        out = ""
-        for j in reversed(range(cols)):
-            out += self.digits[j % 10]
-            for i in range(rows):
-                if self.canvas[i][j] == 0:
-                    out += self.default_char
-                else:
-                    user_id = self.canvas[i][j]
-                    out += architect.get_user_emoji(user_id)
-            out += "\n"
-        out += self.origin_character
-        for i in range(rows):
-            out += self.digits[i % 10]
-        return out
+        return rows * cols > MAX_TEXT_TILES
+
+    def get_view_bounds(self, x, y, width=VIEW_SIZE[0], height=VIEW_SIZE[1]):
+        """The corners (x0, y0), (x1, y1) of the view of width x height tiles
+        centered on (x, y) as much as the borders of the canvas allow
+        (the view is at most MAX_VIEW_SIDE per side and MAX_TEXT_TILES tiles)"""
+        rows, cols = self.get_canvas_shape()
+        width = int(np.clip(width, 1, min(rows, MAX_VIEW_SIDE)))
+        height = int(np.clip(height, 1, min(cols, MAX_VIEW_SIDE, MAX_TEXT_TILES // width)))
+        x, y = self._clip(x, y)
+        x0 = int(np.clip(x - width // 2, 0, rows - width))
+        y0 = int(np.clip(y - height // 2, 0, cols - height))
+        return x0, y0, x0 + width, y0 + height
+
+    def render_view(self, x, y, width=VIEW_SIZE[0], height=VIEW_SIZE[1]) -> str:
+        """Text of the part of the canvas around (x, y), with its coordinates:
+        only the tiles (and the chunks) in the view are read"""
+        x0, y0, x1, y1 = self.get_view_bounds(x, y, width, height)
+        architect = get_architect()
+        emojis = self._get_emojis(architect.get_emoji_table(), architect.emoji_version)
+        cells = emojis[self.grid[x0:x1, y0:y1]]
+        lines = [self.digits[(y0 + j) % 10] + "".join(cells[:, j]) for j in range(y1 - y0)]
+        footer = self.origin_character + "".join(self.digits[i % 10] for i in range(x0, x1))
+        return f"📍 {x0}..{x1 - 1} x {y0}..{y1 - 1}\n" + "\n".join(reversed(lines)) + "\n" + footer
+
+    def _get_image_window(self):
+        """The part of the canvas in the image: all of it, or only the chunks
+        in use for a chunked canvas (at most MAX_IMAGE_SIDE tiles per side)"""
+        rows, cols = self.get_canvas_shape()
+        if not self.is_chunked():
+            return 0, 0, rows, cols
+        x0, y0, x1, y1 = self.grid.get_bounds()
+        return x0, y0, min(x1, x0 + MAX_IMAGE_SIDE), min(y1, y0 + MAX_IMAGE_SIDE)
+
+    def get_png(self) -> bytes:
+        """Return the canvas as a PNG image"""
+        window = self._get_image_window()
+        if self._image is None or window != self._image_window:
+            x0, y0, x1, y1 = window
+            self._image = CanvasImage((x1 - x0, y1 - y0))
+            self._image_window = window
+        grid = self.grid.get_block(*window) if self.is_chunked() else self.grid
+        architect = get_architect()
+        return self._image.to_png(grid, self.palette, architect.get_emoji_table(), architect.emoji_version)
+
+
+def get_chunks_dir(canvas_name):
+    """The directory of a chunked canvas"""
+    return os.path.join(PLACE_DIR, f"{canvas_name[:-len('.csv')]}.chunks")
+
+
+def _register(place):
+    flusher = get_flusher()
+    if flusher is not None:
+        flusher.register(place)
+    get_async_store(place)
+    _PLACES[place.canvas_name] = place
+
+
+def _open_place(canvas_name) -> Place:
+    """A new Place for the canvas, read from disk.
+    Chunked canvases stay chunked whatever the canvas format."""
+    canvas_format = "chunks" if os.path.isdir(get_chunks_dir(canvas_name)) else None
+    return Place(canvas_name=canvas_name, canvas_format=canvas_format)
+
+
+def get_place(canvas_name="default.csv") -> Place:
+    """Return the shared Place for canvas_name. The canvas is read on first use,
+    and read again only if its file was modified on disk in the meantime."""
+    if not canvas_name.endswith(".csv"):
+        canvas_name += ".csv"
+    place = _PLACES.get(canvas_name)
+    if place is None:
+        place = _open_place(canvas_name)
+        _register(place)
+    elif place.is_stale():
+        place.read_canvas()
+    return place
+
+
+def get_canvas_names() -> list:
+    """Names ("<name>.csv") of the canvases in PLACE_DIR, in any format"""
+    suffixes = (".palette.npy", ".csv", ".npy", ".events", ".chunks")
+    names = set()
+    for file_name in os.listdir(PLACE_DIR) if os.path.isdir(PLACE_DIR) else []:
+        for suffix in suffixes:
+            if file_name.endswith(suffix):
+                names.add(file_name[:-len(suffix)] + ".csv")
+                break
+    return sorted(names | set(_PLACES))
+
+
+async def create_place_async(canvas_name, shape) -> Place:
+    """Create a new (empty) chunked canvas of the given shape, which can be huge:
+    only the chunks that get a tile take memory and disk space.
+    The files are written in the storage I/O thread, the Place is registered in the event loop.
+    ValueError if the name or the shape are not valid, or if a canvas with that name exists."""
+    if canvas_name.endswith(".csv"):
+        canvas_name = canvas_name[:-len(".csv")]
+    if not CANVAS_NAME_PATTERN.match(canvas_name):
+        raise ValueError(f'Invalid canvas name "{canvas_name}"')
+    if len(shape) != 2 or not all(0 < side <= MAX_CANVAS_SIDE for side in shape):
+        raise ValueError(f"The sides of the canvas must be between 1 and {MAX_CANVAS_SIDE}")
+    canvas_name += ".csv"
+    if canvas_name in get_canvas_names():
+        raise ValueError(f'Canvas "{canvas_name}" already exists')
+    place = await run_io(partial(Place, canvas_name=canvas_name, shape=shape, canvas_format="chunks", new=True))
+    if canvas_name in _PLACES:
+        # created by another handler meanwhile
+        raise ValueError(f'Canvas "{canvas_name}" already exists')
+    _register(place)
+    return place
+
+
+async def get_place_async(canvas_name="default.csv") -> Place:
+    """get_place, reading the canvas (if needed) in the storage I/O thread.
+    The shared Place is only changed here, in the event loop: the handlers
+    using it never see it change halfway."""
+    if not canvas_name.endswith(".csv"):
+        canvas_name += ".csv"
+    place = _PLACES.get(canvas_name)
+    if place is None:
+        # nobody else can see the new Place while it is read
+        place = await run_io(_open_place, canvas_name)
+        if canvas_name in _PLACES:
+            # opened by another handler meanwhile
+            return _PLACES[canvas_name]
+        _register(place)
+    elif place.is_stale():
+        state = await run_io(place.read_state)
+        # not if the canvas was changed in memory meanwhile
+        if place.is_stale():
+            place.apply_state(state)
+    return place
+
+
+def set_history_retention(keep_segments):
+    """Older segments of the event logs kept after each snapshot (None: all)"""
+    global KEEP_SEGMENTS
+    assert keep_segments is None or keep_segments >= 0, f"Invalid retention {keep_segments}"
+    KEEP_SEGMENTS = keep_segments
+
+
+def set_canvas_format(canvas_format):
+    """Choose the file format of the canvases opened from now on ("csv", "npy", "log" or "chunks")"""
+    global CANVAS_FORMAT
+    assert canvas_format in CANVAS_FORMATS, f"Unknown canvas format {canvas_format}"
+    CANVAS_FORMAT = canvas_format
@@ -0,0 +1,141 @@
+"""
+Storage backends for the user records of the Architect.
+Every backend loads all the users at once and saves/deletes them in batches.
+"""
+import os
+import ast
+import json
+import sqlite3
+import threading
+from scripts.utils import read_user_csv_file, write_user_csv_file
+
+
+class CsvUserStorage:
+    """One <user_id>.csv file per user"""
+
+    def __init__(self, users_dir):
+        self.users_dir = users_dir
+
+    def get_path(self, user_id):
+        return os.path.join(self.users_dir, f'{user_id}.csv')
+
+    def load_users(self) -> dict:
+        """Return the info of all the users"""
+        users = dict()
+        for file_name in os.listdir(self.users_dir):
+            if file_name.endswith('.csv'):
+                user_id = int(file_name.split('.')[0])
+                users[user_id] = read_user_csv_file(self.get_path(user_id))
+        return users
+
+    def save_users(self, users: dict):
+        """Write the info of the given users"""
+        for user_id, user_info in users.items():
+            write_user_csv_file(self.get_path(user_id), user_info)
+
+    def delete_users(self, user_ids):
+        """Remove the given users"""
+        for user_id in user_ids:
+            path = self.get_path(user_id)
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class SqliteUserStorage:
+    """All the users in one SQLite database (WAL mode).
+    The hot fields have their own typed column, everything else
+    is kept as JSON in the `extra` column."""
+
+    HOT_FIELDS = {"username": "TEXT",
+                  "emoji": "TEXT",
+                  "canvas": "TEXT",
+                  "gems": "INTEGER",
+                  "tiles_count": "INTEGER",
+                  "last_place_time": "REAL",
+                  "admin": "INTEGER",
+                  "santa": "INTEGER"}
+    BOOL_FIELDS = ("admin", "santa")
+    INDEXED_FIELDS = ("admin", "santa")
+    # the leaderboards are kept in memory by the Architect, these indexes only slow down the writes
+    DROPPED_INDEXES = ("gems", "tiles_count")
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self._create_tables()
+
+    def _create_tables(self):
+        columns = ", ".join(f"{field} {sql_type}" for field, sql_type in self.HOT_FIELDS.items())
+        with self.connection:
+            self.connection.execute(f"CREATE TABLE IF NOT EXISTS users "
+                                    f"(user_id INTEGER PRIMARY KEY, {columns}, extra TEXT)")
+            for field in self.INDEXED_FIELDS:
+                self.connection.execute(f"CREATE INDEX IF NOT EXISTS idx_users_{field} ON users ({field})")
+            for field in self.DROPPED_INDEXES:
+                self.connection.execute(f"DROP INDEX IF EXISTS idx_users_{field}")
+
+    def _to_row(self, user_id, user_info: dict) -> tuple:
+        """Split the user info into the hot columns and the JSON extra"""
+        hot = [user_info.get(field) for field in self.HOT_FIELDS]
+        hot = [value.item() if hasattr(value, 'item') else value for value in hot]  # numpy scalars
+        extra = {key: value for key, value in user_info.items() if key not in self.HOT_FIELDS}
+        return (user_id, *hot, json.dumps(extra, default=str))
+
+    def _from_row(self, row) -> dict:
+        """Merge the hot columns and the JSON extra back into the user info"""
+        user_info = dict()
+        for field, value in zip(self.HOT_FIELDS, row[1:-1]):
+            if value is not None:
+                user_info[field] = bool(value) if field in self.BOOL_FIELDS else value
+        user_info.update(json.loads(row[-1]) if row[-1] else dict())
+        return user_info
+
+    def load_users(self) -> dict:
+        """Return the info of all the users"""
+        with self._lock:
+            rows = self.connection.execute("SELECT * FROM users").fetchall()
+        return {row[0]: self._from_row(row) for row in rows}
+
+    def save_users(self, users: dict):
+        """Write the info of the given users in a single transaction"""
+        rows = [self._to_row(user_id, user_info) for user_id, user_info in users.items()]
+        marks = ", ".join("?" * (len(self.HOT_FIELDS) + 2))
+        with self._lock, self.connection:
+            self.connection.executemany(f"INSERT OR REPLACE INTO users VALUES ({marks})", rows)
+
+    def delete_users(self, user_ids):
+        """Remove the given users"""
+        with self._lock, self.connection:
+            self.connection.executemany("DELETE FROM users WHERE user_id = ?",
+                                        [(user_id,) for user_id in user_ids])
+
+    def get_flagged_ids(self, field) -> tuple:
+        """Ids of the users with a true boolean field (e.g. admin, santa)"""
+        assert field in self.BOOL_FIELDS, f"{field} is not a flag"
+        with self._lock:
+            rows = self.connection.execute(f"SELECT user_id FROM users WHERE {field} = 1").fetchall()
+        return tuple(row[0] for row in rows)
+
+    def close(self):
+        with self._lock:
+            self.connection.close()
+
+
+def migrate_csv_to_sqlite(users_dir, db_path) -> int:
+    """Copy all the users of a CSV directory into a SQLite database, return how many"""
+    users = CsvUserStorage(users_dir).load_users()
+    for user_info in users.values():
+        for key, value in user_info.items():
+            # the CSV files keep dicts and lists as their repr
+            if isinstance(value, str) and value[:1] in ('{', '['):
+                try:
+                    user_info[key] = ast.literal_eval(value)
+                except (ValueError, SyntaxError):
+                    pass
+    storage = SqliteUserStorage(db_path)
+    storage.save_users(users)
+    storage.close()
+    return len(users)
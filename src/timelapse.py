@@ -0,0 +1,165 @@
+"""
+Time-lapse of a canvas, built from the placement history in its event log
+(canvas format "log", see src/event_log.py).
+
+A frame is not rendered from scratch: only the cells changed by the
+placements since the previous frame are painted over it, all at once.
+The export runs in a separate process, so it never blocks the bot.
+Only the latest export of each canvas is kept, and reused while
+the history and the colors of its users are the same.
+"""
+import os
+import re
+import zlib
+import shutil
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import cv2
+from src.event_log import EventLog
+from src.canvas_image import get_user_colors, render_pixels, paint_cells, EMPTY_COLOR
+from src.async_storage import get_async_store
+
+
+TIMELAPSE_DIR = "data/timelapses"
+
+FPS = 24
+MAX_FRAMES = 240
+# seconds the final canvas stays on screen
+HOLD_SECONDS = 2
+# largest side of the video (pixels)
+MAX_VIDEO_SIDE = 720
+MAX_CELL_SIZE = 16
+
+# "mp4" (a video for Telegram) or "png" (a directory with one image per frame)
+FORMATS = ("mp4", "png")
+
+_POOL = None
+
+
+def get_pool() -> ProcessPoolExecutor:
+    """The process pool of the exports, started on first use.
+    The workers are spawned, not forked, because the bot process runs other threads."""
+    global _POOL
+    if _POOL is None:
+        _POOL = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn"))
+    return _POOL
+
+
+def iter_frames(canvas, events, emoji_table, n_frames=MAX_FRAMES, cell_size=None):
+    """Yield the images of the canvas as the events are applied, in n_frames steps.
+    The first frame is the canvas before the events, the last one after all of them."""
+    rows, cols = canvas.shape
+    if cell_size is None:
+        cell_size = int(np.clip(MAX_VIDEO_SIDE // max(rows, cols), 1, MAX_CELL_SIZE))
+
+    # palette of all the users that appear, and the cells as palette indices
+    ids = np.unique(np.concatenate([np.ravel(canvas), events["new"], [0]]))
+    palette = np.array(get_user_colors(ids.tolist(), emoji_table), dtype=np.uint8)
+    new_colors = np.searchsorted(ids, events["new"])
+
+    pixels = render_pixels(palette[np.searchsorted(ids, canvas)], cell_size)
+    yield pixels
+
+    bounds = np.linspace(0, len(events), min(n_frames, len(events)) + 1).astype(int)
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        x = events["x"][start:stop].astype(np.int64)
+        y = events["y"][start:stop].astype(np.int64)
+        # only the last event of each cell in the step
+        _, last = np.unique((x * cols + y)[::-1], return_index=True)
+        last = len(x) - 1 - last
+        paint_cells(pixels, cols, x[last], y[last], palette[new_colors[start:stop][last]], cell_size)
+        yield pixels
+
+
+def _even(pixels) -> np.ndarray:
+    """Pad to even width and height, as the video codecs want"""
+    h, w = pixels.shape[:2]
+    if h % 2 == 0 and w % 2 == 0:
+        return pixels
+    return cv2.copyMakeBorder(pixels, 0, h % 2, 0, w % 2, cv2.BORDER_CONSTANT, value=EMPTY_COLOR)
+
+
+def _open_video(path, fps, shape):
+    """H.264 when OpenCV was built with it (Telegram plays it inline), MPEG-4 otherwise"""
+    h, w = shape[:2]
+    for codec in ("avc1", "mp4v"):
+        writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*codec), fps, (w, h))
+        if writer.isOpened():
+            return writer
+    raise RuntimeError("OpenCV can't write MP4 videos")
+
+
+def get_export_key(canvas, events, emoji_table) -> str:
+    """What an export depends on: the number of events and the time of the last one
+    (the oldest segments may have been removed), and the colors of the users"""
+    ids = np.unique(np.concatenate([np.ravel(canvas), events["new"], [0]]))
+    colors = np.array(get_user_colors(ids.tolist(), emoji_table), dtype=np.uint8)
+    last_time = int(events["time"][-1] * 1e6) if len(events) else 0
+    return f"{len(events)}-{last_time}-{zlib.crc32(ids.tobytes() + colors.tobytes()):08x}"
+
+
+def remove_exports(out_dir, name, keep=None):
+    """Remove the exports of a canvas, except the path keep"""
+    pattern = re.compile(re.escape(name) + r"-\d+-\d+-[0-9a-f]{8}(\.mp4)?$")
+    for file_name in os.listdir(out_dir) if os.path.isdir(out_dir) else []:
+        path = os.path.join(out_dir, file_name)
+        if pattern.match(file_name) and path != keep:
+            try:
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+            except OSError as e:
+                # e.g. still being sent on Windows: removed with the next export
+                print(f">>> Could not remove {path}: {e}")
+
+
+def export_timelapse(log_dir, out_dir, emoji_table, fmt="mp4", n_frames=MAX_FRAMES, fps=FPS) -> str:
+    """Write the time-lapse of the canvas whose event log is in log_dir, return its path.
+    An export of the same history, with the same colors, is reused."""
+    assert fmt in FORMATS, f"Unknown time-lapse format {fmt}"
+    canvas, events = EventLog(log_dir).get_history()
+    name = os.path.basename(log_dir.rstrip("/"))[:-len(".events")]
+    key = get_export_key(canvas, events, emoji_table)
+    path = os.path.join(out_dir, f"{name}-{key}" + (".mp4" if fmt == "mp4" else ""))
+    if os.path.exists(path):
+        return path
+    os.makedirs(out_dir, exist_ok=True)
+
+    tmp_path = path + ".tmp" + (".mp4" if fmt == "mp4" else "")
+    frames = iter_frames(canvas, events, emoji_table, n_frames=n_frames)
+    if fmt == "mp4":
+        writer = None
+        try:
+            for pixels in frames:
+                pixels = _even(pixels)
+                if writer is None:
+                    writer = _open_video(tmp_path, fps, pixels.shape)
+                writer.write(pixels)
+            for _ in range(HOLD_SECONDS * fps):
+                writer.write(pixels)
+        finally:
+            if writer is not None:
+                writer.release()
+    else:
+        os.makedirs(tmp_path, exist_ok=True)
+        for i, pixels in enumerate(frames):
+            cv2.imwrite(os.path.join(tmp_path, f"frame-{i:06d}.png"), pixels)
+    os.replace(tmp_path, path)
+    remove_exports(out_dir, name, keep=path)
+    return path
+
+
+async def export_timelapse_async(place, emoji_table, fmt="mp4", n_frames=MAX_FRAMES) -> str:
+    """export_timelapse of a Place, in the process pool,
+    after writing the placements still in memory to its event log"""
+    if place.flusher is get_async_store(place):
+        await get_async_store(place).save()
+    else:
+        # write-behind mode: AsyncStore.save leaves the changes to the flusher
+        await place.flusher.flush_store(place)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_pool(), export_timelapse, place.get_log_dir(),
+                                      TIMELAPSE_DIR, dict(emoji_table), fmt, n_frames)
@@ -0,0 +1,164 @@
+"""
+Webhook mode: a small HTTP server that receives the updates POSTed by Telegram
+and hands them to the bot, as an alternative to run_polling.
+
+The body of a POST can be a single update (what Telegram sends), a list of updates
+or a recorded getUpdates response, so the server can be tested offline:
+curl -H "X-Telegram-Bot-Api-Secret-Token: <secret>" --data @updates.json http://127.0.0.1:8443/
+"""
+import hmac
+import json
+import signal
+import asyncio
+from telegram import Update
+
+
+MAX_BODY_SIZE = 1 << 20
+
+REASONS = {200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found",
+           405: "Method Not Allowed", 413: "Payload Too Large", 500: "Internal Server Error"}
+
+
+class WebhookServer:
+    """HTTP/1.1 server that passes the JSON of each update to `put_update`
+    (a coroutine function, by default the update queue of the Application).
+    At most `max_connections` connections are served at once."""
+
+    def __init__(self, put_update=None, listen="127.0.0.1", port=8443, url_path="",
+                 secret_token=None, max_connections=40):
+        self.put_update = put_update
+        self.listen = listen
+        self.port = port
+        self.url_path = "/" + url_path.strip("/")
+        self.secret_token = secret_token
+        self.max_connections = max_connections
+        self.n_updates = 0
+        self._slots = None
+        self._server = None
+
+    async def start(self):
+        self._slots = asyncio.Semaphore(self.max_connections)
+        self._server = await asyncio.start_server(self._serve, self.listen, self.port)
+        if self.port == 0:
+            # bound to a free port (tests)
+            self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _serve(self, reader, writer):
+        """Serve the requests of a connection, until the client closes it"""
+        async with self._slots:
+            try:
+                keep_alive = True
+                while keep_alive:
+                    request = await self._read_request(reader)
+                    if request is None:
+                        break
+                    try:
+                        status, keep_alive = await self._handle(*request)
+                    except Exception as e:
+                        print(f">>> Webhook: could not handle the request: {e}")
+                        status, keep_alive = 500, False
+                    writer.write(f"HTTP/1.1 {status} {REASONS[status]}\r\n"
+                                 f"Content-Length: 0\r\n"
+                                 f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode())
+                    await writer.drain()
+            except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+                # client gone, or not speaking HTTP
+                pass
+            finally:
+                writer.close()
+
+    @staticmethod
+    async def _read_request(reader):
+        """Return (method, path, headers, body), None when the connection is closed"""
+        line = await reader.readline()
+        if not line.strip():
+            return None
+        method, target, version = line.decode("latin-1").split()
+        headers = {"http-version": version}
+        while True:
+            line = await reader.readline()
+            if not line.strip():
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get("content-length", 0))
+        body = await reader.readexactly(length) if length <= MAX_BODY_SIZE else None
+        return method, target.split("?")[0], headers, body
+
+    async def _handle(self, method, path, headers, body) -> tuple:
+        """Return the HTTP status and whether the connection stays open"""
+        keep_alive = (headers["http-version"] == "HTTP/1.1"
+                      and headers.get("connection", "").lower() != "close")
+        if body is None:
+            return 413, False
+        if path.rstrip("/") != self.url_path.rstrip("/"):
+            return 404, keep_alive
+        if method != "POST":
+            return 405, keep_alive
+        if self.secret_token is not None:
+            token = headers.get("x-telegram-bot-api-secret-token", "")
+            if not hmac.compare_digest(token.encode(), self.secret_token.encode()):
+                return 403, keep_alive
+        try:
+            data = json.loads(body)
+        except ValueError:
+            return 400, keep_alive
+        if isinstance(data, dict) and "result" in data:
+            data = data["result"]
+        if isinstance(data, dict):
+            data = [data]
+        if not isinstance(data, list) or not all(isinstance(update, dict) for update in data):
+            return 400, keep_alive
+        for update in data:
+            try:
+                await self.put_update(update)
+            except (TypeError, ValueError, KeyError, AttributeError):
+                # not an update (Update.de_json rejected it)
+                return 400, keep_alive
+            self.n_updates += 1
+        return 200, keep_alive
+
+
+async def run_webhook(application, server: WebhookServer, webhook_url=None,
+                      drop_pending_updates=False):
+    """Run the Application, fed by the webhook server, until SIGINT or SIGTERM.
+    The webhook is registered on Telegram only when `webhook_url` is given."""
+    async def put_update(data):
+        await application.update_queue.put(Update.de_json(data, application.bot))
+    if server.put_update is None:
+        server.put_update = put_update
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            # Windows: the event loop has no signal handlers, the handler runs in the main thread
+            signal.signal(sig, lambda signum, frame: loop.call_soon_threadsafe(stop.set))
+
+    async with application:
+        if application.post_init is not None:
+            await application.post_init(application)
+        if webhook_url is not None:
+            await application.bot.set_webhook(webhook_url, secret_token=server.secret_token,
+                                              max_connections=server.max_connections,
+                                              allowed_updates=Update.ALL_TYPES,
+                                              drop_pending_updates=drop_pending_updates)
+        await application.start()
+        await server.start()
+        print(f">>> Webhook listening on {server.listen}:{server.port}{server.url_path}")
+        try:
+            await stop.wait()
+        finally:
+            await server.stop()
+            await application.stop()
+    # after the shutdown, as run_polling does
+    if application.post_shutdown is not None:
+        await application.post_shutdown(application)
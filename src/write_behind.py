@@ -0,0 +1,108 @@
+"""
+Write-behind mode: the stores (Architect, Place) apply the changes in memory
+and a background task writes them to disk in batches.
+"""
+import asyncio
+from src.async_storage import run_io
+
+
+# the process-wide flusher, None when the stores write synchronously
+_FLUSHER = None
+
+
+class WriteBehindFlusher:
+    """Flush the pending changes of the registered stores
+    every `interval` seconds, as soon as a store has `batch_size`
+    pending changes, and one last time on stop."""
+
+    def __init__(self, interval=5., batch_size=50):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.stores = []
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._stopping = False
+
+    def register(self, store):
+        """Let the flusher save the store from now on"""
+        store.flusher = self
+        if store not in self.stores:
+            self.stores.append(store)
+
+    def notify(self, store):
+        """Called by a store after a change: wake up the task if the batch is full"""
+        if store.n_pending() >= self.batch_size:
+            self._wakeup.set()
+
+    def n_pending(self) -> int:
+        """Number of changes not yet on disk"""
+        return sum(store.n_pending() for store in self.stores)
+
+    def flush(self):
+        """Write all the pending changes to disk"""
+        for store in self.stores:
+            if store.n_pending():
+                store.flush()
+
+    async def flush_store(self, store):
+        """Write the pending changes of a store to disk in the storage I/O thread and wait
+        for them, and for the writes already scheduled (e.g. before reading its files).
+        If the write fails, its changes stay pending for the next flush."""
+        if not store.n_pending():
+            # the I/O thread runs the writes in order
+            await run_io(lambda: None)
+        else:
+            pending = store.take_pending()
+            try:
+                await run_io(store.write_pending, pending)
+            except Exception as e:
+                print(f">>> Could not save {type(store).__name__}: {e}")
+                store.restore_pending(pending)
+
+    async def flush_async(self):
+        """Write all the pending changes to disk in the storage I/O thread.
+        If the write of a store fails, its changes stay pending for the next flush."""
+        for store in self.stores:
+            if store.n_pending():
+                await self.flush_store(store)
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush_async()
+
+    async def start(self):
+        """Start the background task"""
+        if self._task is None:
+            self._stopping = False
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop the background task and do the final flush.
+        The task is not cancelled: a write is never interrupted halfway."""
+        if self._task is not None:
+            self._stopping = True
+            self._wakeup.set()
+            try:
+                await self._task
+            except Exception as e:
+                print(f">>> Write-behind task failed: {e}")
+            self._task = None
+        await self.flush_async()
+
+
+def enable_write_behind(interval=5., batch_size=50) -> WriteBehindFlusher:
+    """Switch the process to write-behind mode, return the flusher"""
+    global _FLUSHER
+    if _FLUSHER is None:
+        _FLUSHER = WriteBehindFlusher(interval=interval, batch_size=batch_size)
+    return _FLUSHER
+
+
+def get_flusher():
+    """Return the process-wide flusher, or None if write-behind is off"""
+    return _FLUSHER
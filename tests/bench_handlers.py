@@ -0,0 +1,235 @@
+"""
+Offline benchmark of the command handlers.
+The handlers run against generated DATA directories with fake Updates
+and a stub bot that records the replies, so no network is needed.
+
+Usage (from the repository root):
+python -m tests.bench_handlers --users 10 1000 100000 --canvas 20 1000
+"""
+import os
+import sys
+import asyncio
+import argparse
+import tempfile
+import tracemalloc
+from time import perf_counter
+from types import SimpleNamespace
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import src.architect
+import src.place
+import src.outbox
+from src.architect import get_architect
+from src.place import get_place
+from src.commands import COMMANDS, ADMIN_COMMNADS
+from src.async_storage import get_async_store
+from src.outbox import configure_outbox
+from scripts.utils import DEFAULT_EMOJI, write_user_csv_file
+from scripts.interaction_log import start_interaction_log, stop_interaction_log
+from scripts.moderation import Moderator
+
+
+ADMIN_ID = 1
+
+
+class StubMessage:
+    """Stands for telegram.Message, records the replies instead of sending them"""
+
+    def __init__(self, text, replies):
+        self.text = text
+        self.replies = replies
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+
+    async def reply_html(self, text, **kwargs):
+        self.replies.append(text)
+
+    async def reply_photo(self, photo, **kwargs):
+        self.replies.append(photo)
+
+    async def reply_video(self, video, **kwargs):
+        self.replies.append(video)
+
+
+class StubUser:
+    def __init__(self, user_id):
+        self.id = user_id
+        self.first_name = f"user{user_id}"
+        self.last_name = None
+
+    def mention_html(self):
+        return self.first_name
+
+
+def make_update(text, user_id, replies):
+    """Return a fake Update for the message `text` sent by `user_id`"""
+    return SimpleNamespace(effective_user=StubUser(user_id),
+                           effective_chat=SimpleNamespace(id=user_id),
+                           message=StubMessage(text, replies),
+                           callback_query=None)
+
+
+def make_context(text):
+    """Return a fake CallbackContext with the command arguments"""
+    return SimpleNamespace(args=text.split()[1:], bot_data=dict(), user_data=dict())
+
+
+def generate_data(root, n_users, canvas_size, seed=0):
+    """Create DATA/ (users) and data/canvases/ (one square canvas) in root"""
+    rng = np.random.default_rng(seed)
+    users_dir = os.path.join(root, "DATA", "PRIVATE", "users")
+    canvases_dir = os.path.join(root, "data", "canvases")
+    os.makedirs(users_dir, exist_ok=True)
+    os.makedirs(canvases_dir, exist_ok=True)
+
+    user_ids = np.arange(ADMIN_ID, ADMIN_ID + n_users)
+    for user_id in user_ids.tolist():
+        user_info = {"username": f"user{user_id}",
+                     "emoji": DEFAULT_EMOJI[user_id % len(DEFAULT_EMOJI)],
+                     "gems": int(rng.integers(0, 100)),
+                     "tiles_count": int(rng.integers(0, 100)),
+                     "canvas": "bench.csv"}
+        if user_id == ADMIN_ID:
+            user_info["admin"] = True
+            user_info["gems"] = 10 ** 9
+        write_user_csv_file(os.path.join(users_dir, f"{user_id}.csv"), user_info)
+
+    # a quarter of the tiles is empty
+    canvas = rng.choice(user_ids, size=(canvas_size, canvas_size))
+    canvas[rng.random(canvas.shape) < .25] = 0
+    np.savetxt(os.path.join(canvases_dir, "bench.csv"), canvas, fmt="%d", delimiter=",")
+
+
+def reset_registries():
+    """Forget the shared Architect and Places, so that the next run loads its own DATA"""
+    src.architect._ARCHITECTS.clear()
+    src.place._PLACES.clear()
+
+
+BENCHMARKS = (("/help", COMMANDS["help"]),
+              ("/place", COMMANDS["place"]),
+              ("/place 3 4", COMMANDS["place"]),
+              ("/place view 9 9", COMMANDS["place"]),
+              ("/place tiles", COMMANDS["place"]),
+              ("/place png", COMMANDS["place"]),
+              ("/place stats", COMMANDS["place"]),
+              ("/leaderboard", COMMANDS["leaderboard"]),
+              ("/gamble 1", COMMANDS["gamble"]),
+              ("/give_gems 2 1", ADMIN_COMMNADS["give_gems"]),
+              ("/list_gems", ADMIN_COMMNADS["list_gems"]),
+              ("/get_ids", ADMIN_COMMNADS["get_ids"]))
+
+
+async def run_command(text, handler):
+    replies = []
+    await handler(make_update(text, ADMIN_ID, replies), make_context(text))
+    # the handlers only queue their replies
+    await src.outbox.OUTBOX.join()
+    assert replies, f"{text} did not reply"
+
+
+async def bench_command(text, handler, min_time):
+    """Return ops/sec and the peak memory allocated by one call (KiB)"""
+    await run_command(text, handler)  # warm up the caches
+
+    n = 0
+    start = perf_counter()
+    while perf_counter() - start < min_time:
+        await run_command(text, handler)
+        n += 1
+    ops = n / (perf_counter() - start)
+
+    tracemalloc.start()
+    await run_command(text, handler)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return ops, peak / 1024
+
+
+async def bench(n_users, canvas_size, min_time, storage):
+    """Benchmark all the commands on a freshly generated DATA directory"""
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as root:
+        generate_data(root, n_users, canvas_size)
+        os.chdir(root)
+        start_interaction_log("interactions.jsonl", console=False)
+        try:
+            reset_registries()
+            # measure the handlers, not the Telegram rate limits
+            configure_outbox(rate=1e9, burst=10 ** 6, chat_rate=1e9, chat_burst=10 ** 6)
+            start = perf_counter()
+            get_architect(storage=storage)
+            get_place("bench").minutes_cooldown = 0
+            print(f"\n{n_users} users, {canvas_size}x{canvas_size} canvas "
+                  f"(startup {perf_counter() - start:.2f} s)")
+            for text, handler in BENCHMARKS:
+                ops, peak = await bench_command(text, handler, min_time)
+                print(f"{text:<16} {ops:>10.1f} ops/s {peak:>12.1f} KiB peak")
+            # let the storage I/O thread finish before the directory is removed
+            await get_async_store(get_architect()).save()
+            await get_async_store(get_place("bench")).save()
+        finally:
+            stop_interaction_log()
+            os.chdir(cwd)
+            reset_registries()
+
+
+def baseline_moderate(text, word_path):
+    """moderate() before the compiled moderation engine, to compare with"""
+    with open(word_path, 'r') as f:
+        bad_words = f.read().splitlines()
+    for bad_word in bad_words:
+        if len(bad_word) < 5:
+            continue
+        text = text.replace(bad_word, '*' * len(bad_word))
+    return text
+
+
+def get_ops(func, min_time) -> float:
+    n = 0
+    start = perf_counter()
+    while perf_counter() - start < min_time:
+        func()
+        n += 1
+    return n / (perf_counter() - start)
+
+
+def bench_moderation(min_time, seed=0):
+    """Moderation of messages of a few lengths, against the baseline"""
+    word_path = os.path.join(ROOT, "data", "bad_words.txt")
+    moderator = Moderator.from_file(word_path)
+    with open(word_path, 'r') as f:
+        bad_words = [w for w in f.read().splitlines() if len(w) >= 5]
+    rng = np.random.default_rng(seed)
+    words = ["ciao", "come", "stai", "canvas", "gemme", "hello", "world", "place"]
+    print("\nmoderation")
+    for length in (25, 300, 4400):
+        text = ""
+        while len(text) < length:
+            text += " " + (rng.choice(bad_words) if rng.random() < .03 else rng.choice(words))
+        text = text[:length]
+        ops = get_ops(lambda: moderator.moderate(text), min_time)
+        baseline_ops = get_ops(lambda: baseline_moderate(text, word_path), min_time)
+        print(f"{length:>5} chars {ops:>10.1f} ops/s  (baseline {baseline_ops:.1f} ops/s, "
+              f"{ops / baseline_ops:.1f}x)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of the command handlers")
+    parser.add_argument("--users", type=int, nargs="+", default=[10, 1000])
+    parser.add_argument("--canvas", type=int, nargs="+", default=[20, 200])
+    parser.add_argument("--time", type=float, default=.5, help="seconds per command")
+    parser.add_argument("--storage", choices=("csv", "sqlite"), default="csv")
+    args = parser.parse_args()
+    bench_moderation(args.time)
+    for n_users in args.users:
+        for canvas_size in args.canvas:
+            asyncio.run(bench(n_users, canvas_size, args.time, args.storage))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,231 @@
+"""
+Round trips of the canvas file formats (csv, npy, log, chunks) in a temporary PLACE_DIR.
+
+Usage (from the repository root):
+python -m pytest tests/test_storage_formats.py
+"""
+import os
+import sys
+import errno
+import tempfile
+from contextlib import contextmanager
+from types import SimpleNamespace
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import src.place
+import src.event_log
+from src.place import Place, CANVAS_FORMATS, set_history_retention
+from src.event_log import EVENT_DTYPE
+
+
+@contextmanager
+def place_dir():
+    """Canvases in a new empty directory"""
+    old_dir = src.place.PLACE_DIR
+    with tempfile.TemporaryDirectory() as path:
+        src.place.PLACE_DIR = path
+        try:
+            yield path
+        finally:
+            src.place.PLACE_DIR = old_dir
+
+
+@contextmanager
+def history_retention(keep_segments):
+    old_keep_segments = src.place.KEEP_SEGMENTS
+    set_history_retention(keep_segments)
+    try:
+        yield
+    finally:
+        set_history_retention(old_keep_segments)
+
+
+class FullDisk:
+    """open() of a disk that fills up: a write stores half of the bytes, then fails"""
+
+    def __init__(self, path, mode, buffering=-1):
+        self.file = open(path, mode, buffering=buffering)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.file.close()
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+    def write(self, data):
+        self.file.write(bytes(data[:len(data) // 2]))
+        raise OSError(errno.ENOSPC, "No space left on device")
+
+
+def paint(place, n, seed=0):
+    """n random placements by a few users, some of them emptying a tile"""
+    rng = np.random.default_rng(seed)
+    rows, cols = place.get_canvas_shape()
+    for _ in range(n):
+        place.set_item(int(rng.integers(rows)), int(rng.integers(cols)), int(rng.choice([0, 11, 22, 33])))
+
+
+def test_reload_equality():
+    for canvas_format in CANVAS_FORMATS:
+        with place_dir():
+            # more than one chunk per side
+            place = Place("test", shape=(70, 90), canvas_format=canvas_format)
+            paint(place, 200)
+            reloaded = Place("test", canvas_format=canvas_format)
+            assert reloaded.get_canvas_shape() == (70, 90), canvas_format
+            assert np.array_equal(reloaded.canvas, place.canvas), canvas_format
+
+
+def test_torn_event_record():
+    with place_dir():
+        place = Place("test", shape=(10, 10), canvas_format="log")
+        paint(place, 20)
+        path = place.event_log._events_path(place.event_log.segment)
+        size = os.path.getsize(path)
+        with open(path, "ab") as f:
+            # crash halfway through the append of a placement
+            f.write(b"\x01" * (EVENT_DTYPE.itemsize // 2))
+        reloaded = Place("test", canvas_format="log")
+        assert np.array_equal(reloaded.canvas, place.canvas)
+        assert os.path.getsize(path) == size
+        # the next placements go after the last whole record
+        reloaded.set_item(1, 2, 44)
+        assert np.array_equal(Place("test", canvas_format="log").canvas, reloaded.canvas)
+
+
+def test_failed_append():
+    with place_dir():
+        place = Place("test", shape=(10, 10), canvas_format="log")
+        paint(place, 10)
+        # write-behind: the placements are written by take_pending / write_pending
+        place.flusher = SimpleNamespace(notify=lambda store: None)
+        paint(place, 10, seed=1)
+        pending = place.take_pending()
+        src.event_log.open = FullDisk
+        try:
+            place.write_pending(pending)
+            assert False, "the write did not fail"
+        except OSError:
+            place.restore_pending(pending)
+        finally:
+            del src.event_log.open
+        # tried again, with the placements made meanwhile
+        paint(place, 10, seed=2)
+        place.flush()
+        reloaded = Place("test", canvas_format="log")
+        assert np.array_equal(reloaded.canvas, place.canvas)
+        _, events = reloaded.event_log.get_history()
+        assert len(events) == 30
+
+
+def test_palette_overflow():
+    for canvas_format in ("npy", "chunks"):
+        with place_dir():
+            place = Place("test", shape=(20, 20), canvas_format=canvas_format)
+            for i in range(300):
+                place.set_item(i // 20, i % 20, 1000 + i)
+            assert place.grid.dtype == np.uint16, canvas_format
+            reloaded = Place("test", canvas_format=canvas_format)
+            assert reloaded.grid.dtype == np.uint16, canvas_format
+            assert np.array_equal(reloaded.canvas, place.canvas), canvas_format
+
+
+def test_palette_compaction():
+    for canvas_format in ("npy", "chunks"):
+        with place_dir():
+            place = Place("test", shape=(20, 20), canvas_format=canvas_format)
+            # many users, few of them still on the canvas: the palette is compacted, not widened
+            for i in range(1000):
+                place.set_item(i % 3, 0, 1000 + i)
+            assert place.grid.dtype == np.uint8, canvas_format
+            assert len(place.palette) <= 256, canvas_format
+            reloaded = Place("test", canvas_format=canvas_format)
+            assert np.array_equal(reloaded.canvas, place.canvas), canvas_format
+            if canvas_format == "npy":
+                # written again through the memory map
+                place.set_item(5, 5, 11)
+                assert isinstance(place.grid, np.memmap)
+                assert np.array_equal(Place("test", canvas_format="npy").canvas, place.canvas)
+
+
+def test_palette_rewrite_crash():
+    for grid_replaced in (False, True):
+        with place_dir():
+            place = Place("test", shape=(20, 20), canvas_format="npy")
+            for i in range(255):
+                place.set_item(i // 20, i % 20, 1000 + i)
+            before = place.canvas
+            # write-behind: the compaction of the palette is written by take_pending / write_pending
+            place.flusher = SimpleNamespace(notify=lambda store: None)
+            place.set_item(19, 19, 2000)
+            palette, grid = place.take_pending()
+            assert grid is not None and place.palette[grid].tolist() == place.canvas.tolist()
+            # crash in the middle of _rewrite_binary
+            grid_path, palette_path = place._get_rewrite_paths()
+            with open(grid_path, "wb") as f:
+                np.save(f, grid)
+            with open(palette_path, "wb") as f:
+                np.save(f, palette)
+            if grid_replaced:
+                os.replace(grid_path, place.get_binary_path())
+            reloaded = Place("test", canvas_format="npy")
+            assert np.array_equal(reloaded.canvas, place.canvas if grid_replaced else before), grid_replaced
+            assert not os.path.exists(grid_path) and not os.path.exists(palette_path)
+
+
+def test_empty_chunks_deleted():
+    with place_dir():
+        place = Place("test", shape=(200, 200), canvas_format="chunks")
+        place.set_item(5, 5, 11)
+        place.set_item(150, 150, 22)
+        assert place.grid.n_chunks() == 2
+        place.set_item(150, 150, 0)
+        chunks = sorted(name for name in os.listdir(place.get_chunks_dir()) if name.startswith("chunk-"))
+        assert chunks == ["chunk-0-0.npy"]
+        reloaded = Place("test", canvas_format="chunks")
+        assert reloaded.grid.n_chunks() == 1
+        assert np.array_equal(reloaded.canvas, place.canvas)
+
+
+def test_compaction_keeps_all_history():
+    with place_dir(), history_retention(None):
+        place = Place("test", shape=(10, 10), canvas_format="log")
+        for i in range(3):
+            paint(place, 10, seed=i)
+            place.compact()
+        assert place.event_log.get_segments() == [0, 1, 2, 3]
+        canvas, events = place.event_log.get_history()
+        assert not canvas.any() and len(events) == 30
+        assert np.array_equal(place.event_log.canvas_at(events["time"][-1]), place.canvas)
+
+
+def test_compaction_retention():
+    with place_dir(), history_retention(1):
+        place = Place("test", shape=(10, 10), canvas_format="log")
+        for i in range(3):
+            paint(place, 10, seed=i)
+            place.compact()
+        # the current segment and the one before it
+        assert place.event_log.get_segments() == [2, 3]
+        _, events = place.event_log.get_history()
+        assert len(events) == 10
+        reloaded = Place("test", canvas_format="log")
+        assert np.array_equal(reloaded.canvas, place.canvas)
+
+
+if __name__ == '__main__':
+    test_reload_equality()
+    test_torn_event_record()
+    test_failed_append()
+    test_palette_overflow()
+    test_palette_compaction()
+    test_palette_rewrite_crash()
+    test_empty_chunks_deleted()
+    test_compaction_keeps_all_history()
+    test_compaction_retention()
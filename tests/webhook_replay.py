@@ -0,0 +1,100 @@
+"""
+Offline test of the webhook mode: recorded updates are POSTed to a local
+WebhookServer, which passes them to the command handlers with the stub bot
+of the benchmark, so neither Telegram nor the network is needed.
+
+Usage (from the repository root):
+python -m tests.webhook_replay [updates.json]
+where updates.json is an update, a list of updates or a getUpdates response.
+"""
+import os
+import sys
+import json
+import asyncio
+import tempfile
+from urllib.request import Request, urlopen
+from urllib.error import HTTPError
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import src.outbox
+from src.webhook import WebhookServer
+from src.commands import COMMANDS, ADMIN_COMMNADS
+from tests.bench_handlers import ADMIN_ID, generate_data, reset_registries, make_update, make_context
+
+SECRET = "replay-secret"
+
+HANDLERS = {**COMMANDS, **ADMIN_COMMNADS}
+
+
+def recorded_updates(texts, user_id=ADMIN_ID):
+    """Updates like the ones Telegram sends for the messages `texts`"""
+    return [{"update_id": i,
+             "message": {"message_id": i, "date": 0, "text": text,
+                         "chat": {"id": user_id, "type": "private"},
+                         "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}}}
+            for i, text in enumerate(texts)]
+
+
+def post(url, data, secret=SECRET) -> int:
+    """POST the JSON data, return the HTTP status"""
+    request = Request(url, data=json.dumps(data).encode(), method="POST",
+                      headers={"Content-Type": "application/json",
+                               "X-Telegram-Bot-Api-Secret-Token": secret})
+    try:
+        with urlopen(request) as response:
+            return response.status
+    except HTTPError as e:
+        return e.code
+
+
+async def replay(updates):
+    replies = []
+
+    async def put_update(data):
+        # dispatch the command to its handler, with the stub bot
+        message = data["message"]
+        command = message["text"].split()[0].lstrip("/")
+        await HANDLERS[command](make_update(message["text"], message["from"]["id"], replies),
+                                make_context(message["text"]))
+
+    server = WebhookServer(put_update, port=0, url_path="hook", secret_token=SECRET)
+    await server.start()
+    url = f"http://127.0.0.1:{server.port}/hook"
+    try:
+        assert await asyncio.to_thread(post, url, updates[:1], "wrong") == 403
+        assert await asyncio.to_thread(post, url.replace("hook", "other"), updates[:1]) == 404
+        # one update per request, as Telegram does, then the rest as a batch
+        assert await asyncio.to_thread(post, url, updates[0]) == 200
+        assert await asyncio.to_thread(post, url, {"ok": True, "result": updates[1:]}) == 200
+    finally:
+        await server.stop()
+    # the handlers only queue their replies
+    await src.outbox.OUTBOX.join()
+    print(f"{server.n_updates} updates, {len(replies)} replies")
+    assert server.n_updates == len(updates)
+
+
+def main():
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], encoding="utf-8") as f:
+            updates = json.load(f)
+        if isinstance(updates, dict):
+            updates = updates.get("result", [updates])
+    else:
+        updates = recorded_updates(["/help", "/place", "/place 1 1", "/leaderboard", "/gamble 1"])
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as root:
+        generate_data(root, n_users=10, canvas_size=10)
+        os.chdir(root)
+        try:
+            reset_registries()
+            asyncio.run(replay(updates))
+        finally:
+            os.chdir(cwd)
+            reset_registries()
+
+
+if __name__ == '__main__':
+    main()